@@ -5,8 +5,6 @@ import json
 from pprint import pprint
 import time
 import hashlib
-from baidupcsapi import PCS
-from common.models import ModelBooks, BookStatus
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
@@ -29,12 +27,14 @@ def parse_filename(path):
     return filename
 
 
-def upload_file(path, dest, pcs, filename=None, delete=False):
+def upload_file(path, dest, pcs, filename=None, delete=False, on_progress=None):
     def upload_callback(*args, **kwargs):
         progress = round(kwargs['progress'] * 100 / kwargs['size'], 2)
         logging.info('In progress, {}%, {}/{}, "{}" -> "{}"'.format(
             progress, kwargs['progress'], kwargs['size'], path, dest)
         )
+        if on_progress is not None:
+            on_progress()
 
     if not os.path.exists(path):
         logging.info('Already Uploaded, "{}" -> "{}"'.format(path, dest))
@@ -84,23 +84,48 @@ def upload_folder(folder, dest, pcs, delete=False):
             upload_file(path, dest, pcs, delete=delete)
 
 
+def lease_heartbeat(safari_book_id):
+    """Return a function renewing the lease on `safari_book_id`, at most every third of the lease"""
+    from common.models import ModelBooks
+    from safaribooks.settings import BOOK_LEASE_SECONDS
+
+    last = [time.time()]
+
+    def heartbeat():
+        if time.time() - last[0] >= BOOK_LEASE_SECONDS / 3.0:
+            ModelBooks.heartbeat([safari_book_id])
+            last[0] = time.time()
+
+    return heartbeat
+
+
 def func_upload(args, pcs):
     if args.loop:
+        # The database is only needed to upload from it.
+        from common.listener import StatusListener
+        from common.models import ModelBooks, BookStatus
+
+        # Woken up as soon as a download finishes, looking again every 30s
+        # anyway in case a notification is missed.
+        listener = StatusListener([BookStatus.DOWNLOADED])
         while True:
             book = ModelBooks.get_a_book(status=BookStatus.DOWNLOADED, next_status=BookStatus.UPLOADING)
             if not book:
-                logging.info('Sleep, no available books to upload now')
-                time.sleep(30)
+                logging.info('Wait, no available books to upload now')
+                listener.wait(30)
                 continue
             path = os.path.join(args.path, '{}.epub'.format(book.safari_book_id))
             finish_status = BookStatus.DOWNLOADED
             try:
-                upload_file(path, args.folder, pcs, filename='{}.epub'.format(book.safari_book_id), delete=args.delete)
+                upload_file(path, args.folder, pcs, filename='{}.epub'.format(book.safari_book_id), delete=args.delete,
+                            on_progress=lease_heartbeat(book.safari_book_id))
                 finish_status = BookStatus.UPLOADED
             except BaseException as e:
                 logging.error("Fail, {}".format(str(e)), exc_info=True)
             finally:
-                ModelBooks.finish(book.safari_book_id, status=finish_status)
+                # A failed upload backs off before the book is claimed again.
+                ModelBooks.finish(book.safari_book_id, status=finish_status,
+                                  failed=finish_status != BookStatus.UPLOADED)
 
     elif os.path.isdir(args.path):
         upload_folder(args.path, args.folder, pcs, delete=args.delete)
@@ -166,6 +191,8 @@ list_parser.set_defaults(func=func_list)
 
 def main():
     args = parser.parse_args()
+    # Loaded once the arguments are parsed, it pulls in requests and rsa.
+    from baidupcsapi import PCS
     pcs = PCS(username=args.username, password=args.password, cookie=args.cookie)
     args.func(args, pcs)
 
@@ -0,0 +1,90 @@
+"""
+Benchmark `safaribooks.extract.extract_body` against BeautifulSoup
+
+Run it from the repository root against a directory of downloaded chapter
+html, e.g. pages saved from `SafariBooksSpider.parse_page`:
+
+    python benchmarks/extract_body.py path/to/chapters -n 5
+
+Every page, and a few indented samples, are checked to give the same output
+with both extractors, then both are timed over the whole corpus.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safaribooks.extract import extract_body, _soup_body  # noqa: E402
+
+# Indented pages, whose whitespace only text BeautifulSoup collapses outside
+# of pre and textarea.
+SAMPLES = [
+    ('<indented>', b'<html><body>\n    <p>a</p>\n    <p>b</p>\n  </body></html>'),
+    ('<indented xhtml>', b'''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <head><title>Chapter</title></head>
+  <body>
+    <section>
+      <h1>Title</h1>
+      <p>a <em>b</em>  <em>c</em>\t</p>
+
+      <ul>
+        <li>x</li>
+      </ul>
+      <pre>
+  <code>  indented</code>
+  <span>   </span>
+      </pre>
+      <textarea>   </textarea>
+      <!--   -->
+    </section>
+  </body>
+</html>
+'''),
+]
+
+
+def load_corpus(directory):
+    corpus = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.endswith(('.html', '.xhtml', '.htm')):
+                with open(os.path.join(root, name), 'rb') as fh:
+                    corpus.append((os.path.join(root, name), fh.read()))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark extract_body against BeautifulSoup')
+    parser.add_argument('corpus', help='Directory of chapter html files')
+    parser.add_argument('-n', '--number', type=int, default=3, help='Passes over the corpus')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        parser.error('no html files in {}'.format(args.corpus))
+
+    mismatches = [path for path, content in SAMPLES + corpus if extract_body(content) != _soup_body(content)]
+    for path in mismatches:
+        print('MISMATCH {}'.format(path))
+
+    size = sum(len(content) for _, content in corpus)
+    print('{} pages, {:.1f} MB, {} mismatches'.format(len(corpus), size / 1e6, len(mismatches)))
+
+    results = {}
+    for name, fn in (('beautifulsoup', _soup_body), ('extract_body', extract_body)):
+        seconds = min(timeit.repeat(
+            lambda: [fn(content) for _, content in corpus], number=1, repeat=args.number,
+        ))
+        results[name] = seconds
+        print('{:<14} {:8.3f} s  {:8.1f} MB/s'.format(name, seconds, size / 1e6 / seconds))
+    print('speedup {:.1f}x'.format(results['beautifulsoup'] / results['extract_body']))
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Benchmark the start up of the command lines
+
+Run it from the repository root:
+
+    python benchmarks/import_time.py -n 10
+
+Every command is started `-n` times in a fresh interpreter and timed until
+it exits. Importing the command line modules must not load the heavy
+dependencies, which only the subcommands using them import, so the run
+fails if any of them is loaded, or if a command is slower than `--max-ms`.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+    ('safaribooks --help', ['-m', 'safaribooks', '--help']),
+    ('safaribooks convert-to-mobi', ['-m', 'safaribooks', 'convert-to-mobi', '--help']),
+    ('baidupcsapi --help', ['baidupcsapi', '--help']),
+    ('baidupcsapi list', ['baidupcsapi', 'list', '--help']),
+]
+
+# Modules no command line may load before it knows it needs them.
+HEAVY_MODULES = ['scrapy', 'twisted', 'sqlalchemy', 'psycopg2', 'lxml', 'bs4', 'requests', 'rsa', 'requests_toolbelt']
+
+CHECK_MODULES = '''
+import runpy, sys, traceback
+sys.argv = [{path!r}]
+try:
+    runpy.run_path({path!r}, run_name='not_main')
+except Exception:
+    traceback.print_exc()
+print(' '.join(sorted(name for name in {heavy!r} if name in sys.modules)))
+'''
+
+
+def run(argv):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.time()
+    subprocess.check_call([sys.executable] + argv, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    return time.time() - start
+
+
+def heavy_modules(path):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    code = CHECK_MODULES.format(path=os.path.join(ROOT, path), heavy=HEAVY_MODULES)
+    return subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=env).decode().split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the start up of the command lines')
+    parser.add_argument('-n', '--number', type=int, default=5, help='Runs of every command')
+    parser.add_argument('--max-ms', type=float, default=None, help='Fail if a command takes longer')
+    args = parser.parse_args()
+
+    failed = False
+    for path in ('safaribooks/__main__.py', 'baidupcsapi/__main__.py'):
+        loaded = heavy_modules(path)
+        if loaded:
+            failed = True
+            print('{} loads {}'.format(path, ', '.join(loaded)))
+
+    baseline = min(run(['-c', 'pass']) for _ in range(args.number))
+    print('{:<30} {:8.1f} ms'.format('python', baseline * 1000))
+    for name, argv in COMMANDS:
+        seconds = min(run(argv) for _ in range(args.number))
+        print('{:<30} {:8.1f} ms'.format(name, seconds * 1000))
+        if args.max_ms is not None and seconds * 1000 > args.max_ms:
+            failed = True
+            print('{} is over {} ms'.format(name, args.max_ms))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
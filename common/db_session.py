@@ -5,6 +5,7 @@ get sqlalchemy session
 """
 
 import logging
+import os
 import traceback
 from functools import wraps
 
@@ -43,7 +44,7 @@ def get_connection_string(db_conf):
 
 
 def get_session(db_conf, debug=False, application_name="default", statement_timeout=5000,
-                pool_recycle=-1, pool_size=1, isolation_level=None):
+                pool_recycle=-1, pool_size=1, pool_timeout=30, isolation_level=None):
     """Get session
 
     :param dict db_conf: a dict to describe the config of database.
@@ -55,6 +56,7 @@ def get_session(db_conf, debug=False, application_name="default", statement_time
     :param int statement_timeout: Cancel statement due to statement timeout.
     :param int pool_recycle: Causes the pool to recycle connections after the given number of seconds.
     :param int pool_size: the number of connections to keep open inside the connection pool. Default is 5.
+    :param int pool_timeout: Seconds to wait for a connection of the pool before giving up.
     :param string isolation_level: Affect the transaction isolation level of the database connection.
                                    Default is None. You could set it as 'AUTOCOMMIT' to enable real autocommit.
     :rtype: scoped_session
@@ -66,6 +68,7 @@ def get_session(db_conf, debug=False, application_name="default", statement_time
             poolclass=QueuePool,
             pool_recycle=pool_recycle,  # recycle connections after 30 minutes
             pool_size=pool_size,
+            pool_timeout=pool_timeout,
             echo=debug,
             connect_args={
                 "application_name": application_name,
@@ -102,10 +105,46 @@ def create_db_session(isolation_level=TransactionIsolationLevel.READ_WRITE):
     :return: db session
     :rtype: Session
     """
-    return get_session(safaribooks.settings.DATABASE, isolation_level=isolation_level.value)()
+    settings = safaribooks.settings
+    return get_session(
+        settings.DATABASE,
+        statement_timeout=settings.DATABASE_STATEMENT_TIMEOUT,
+        pool_recycle=settings.DATABASE_POOL_RECYCLE,
+        pool_size=settings.DATABASE_POOL_SIZE,
+        pool_timeout=settings.DATABASE_POOL_TIMEOUT,
+        isolation_level=isolation_level.value,
+    )()
+
+
+class LazySession(object):
+    """The session of the current process, created on first use
+
+    Importing the models costs no engine setup, so command lines which don't
+    touch the database don't pay for it. A forked child gets a session and a
+    pool of its own on first use, the connections inherited from the parent
+    are dropped without being closed, they still belong to the parent.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._session = None
+        self._pid = None
+
+    def _get(self):
+        pid = os.getpid()
+        if self._session is not None and self._pid != pid:
+            self._session.get_bind().dispose(close=False)
+            self._session = None
+        if self._session is None:
+            self._session = self._factory()
+            self._pid = pid
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
 
 
-SESSION = create_db_session()  # type: Session
+SESSION = LazySession(create_db_session)  # type: Session
 
 
 def with_transaction(wrapped_fn):
@@ -0,0 +1,114 @@
+"""
+Wait for status changes of `books` announced with NOTIFY
+"""
+
+import logging
+import select
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import safaribooks.settings
+from common.db_session import get_connection_string
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'books_status'
+
+
+class StatusListener(object):
+    """LISTEN on its own connection for books moved to one of `statuses`
+
+    `ModelBooks` sends the new status as payload, the notification is
+    delivered once the transaction moving the book commits. A worker with
+    nothing to do blocks in `wait` instead of polling the table.
+
+    It can also be registered with ``reactor.addReader``, `on_notify` is then
+    called whenever one of `statuses` is announced. If the connection breaks
+    the reactor drops the listener and `on_lost` is called, it is not
+    reconnected, a new listener has to be registered.
+    """
+
+    def __init__(self, statuses, on_notify=None, on_lost=None):
+        self.statuses = set(str(status) for status in statuses)
+        self.on_notify = on_notify
+        self.on_lost = on_lost
+        self._conn = None
+        self._fileno = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = psycopg2.connect(get_connection_string(safaribooks.settings.DATABASE))
+            self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            self._conn.cursor().execute('LISTEN {}'.format(CHANNEL))
+            self._fileno = self._conn.fileno()
+        return self._conn
+
+    def fileno(self):
+        # The reactor asks again to unregister the listener, that must not
+        # connect, nor fail on a broken connection. -1 once closed.
+        if self._fileno is None:
+            self._connect()
+        return self._fileno
+
+    def poll(self):
+        """Read the pending notifications, return True if one of `statuses` is among them"""
+        conn = self._connect()
+        conn.poll()
+        notified = False
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            if notify.payload in self.statuses:
+                notified = True
+        return notified
+
+    def wait(self, timeout):
+        """Block until one of `statuses` is announced or `timeout` seconds passed
+
+        :return: True if notified. On timeout or when the connection broke,
+            the caller should look for work anyway. A broken connection still
+            blocks for the rest of `timeout`, so callers keep polling at the
+            intended rate while the database can't be reached.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            if self.poll():
+                return True
+            readable, _, _ = select.select([self._conn], [], [], timeout)
+            return bool(readable) and self.poll()
+        except (psycopg2.Error, select.error, OSError) as e:
+            logger.warning('Listening on {} failed, {}'.format(CHANNEL, e))
+            self.close()
+            time.sleep(max(0, deadline - time.monotonic()))
+            return False
+
+    def doRead(self):
+        try:
+            notified = self.poll()
+        except psycopg2.Error as e:
+            logger.warning('Listening on {} failed, {}'.format(CHANNEL, e))
+            # Only registered with a reactor, the uploader doesn't need Twisted.
+            from twisted.internet.main import CONNECTION_LOST
+            # The reactor removes the reader and calls `connectionLost`.
+            return CONNECTION_LOST
+        if notified and self.on_notify is not None:
+            self.on_notify()
+
+    def logPrefix(self):
+        return CHANNEL
+
+    def connectionLost(self, reason):
+        self.close()
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+        if self._fileno is not None:
+            self._fileno = -1
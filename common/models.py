@@ -1,12 +1,41 @@
-from datetime import datetime
+import csv
+import io
+import json
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
 from sqlalchemy.dialects import postgresql
-from sqlalchemy import Column, DateTime, Integer, VARCHAR, TEXT, SMALLINT
+from sqlalchemy import Column, DateTime, Float, Integer, VARCHAR, TEXT, SMALLINT, literal_column, or_, text
 from sqlalchemy.ext.declarative import declarative_base
 
 from common.db_session import SESSION, with_transaction
+import safaribooks.settings
+
+logger = logging.getLogger(__name__)
 
 BASE = declarative_base()
 
+# Union of the tags of an existing book and of `{tags}`, those of the one
+# being upserted or the ones merged in.
+MERGE_TAGS = (
+    "(SELECT COALESCE(jsonb_agg(DISTINCT tag), '[]'::jsonb) "
+    "FROM jsonb_array_elements(COALESCE(books.tags, '[]'::jsonb) || {tags}) AS tag)"
+)
+MISSING_TAGS = "NOT COALESCE(books.tags, '[]'::jsonb) @> {tags}"
+
+STAGING_COLUMNS = [
+    'safari_book_id', 'reviews', 'rating', 'popularity', 'report_score', 'pages', 'title', 'description',
+    'language', 'authors', 'publishers', 'tags', 'url', 'web_url',
+]
+STAGING_JSON_COLUMNS = frozenset(['authors', 'publishers', 'tags'])
+# Staged as NUMERIC, the search API gives fractional ratings, cast like `upsert` does.
+STAGING_NUMERIC_COLUMNS = frozenset(['reviews', 'rating', 'popularity', 'report_score', 'pages'])
+# CSV reads an unquoted empty field as NULL, these are empty strings.
+STAGING_TEXT_COLUMNS = [
+    column for column in STAGING_COLUMNS if column not in STAGING_JSON_COLUMNS | STAGING_NUMERIC_COLUMNS
+]
+
 
 class BookStatus():
     NOT_DOWNLOADED = 0
@@ -16,6 +45,26 @@ class BookStatus():
     UPLOADED = 4
 
 
+# Statuses held under a lease, and the ones they return to once it expires.
+LEASED_STATUSES = {
+    BookStatus.DOWNLOADING: BookStatus.NOT_DOWNLOADED,
+    BookStatus.UPLOADING: BookStatus.DOWNLOADED,
+}
+
+
+def notify_status(status):
+    """Announce that books moved to `status`, once the current transaction commits
+
+    See `common.listener.StatusListener`.
+    """
+    SESSION.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': 'books_status', 'payload': str(status)})
+
+
+def lease_owner():
+    """Name of this worker in the leases of `books`"""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
 class ModelBooks(BASE):
     __tablename__ = 'books'
 
@@ -37,6 +86,10 @@ class ModelBooks(BASE):
     tags = Column(postgresql.JSONB, default=[])
     url = Column(VARCHAR(4096), nullable=False, default='')
     web_url = Column(VARCHAR(4096), nullable=False, default='')
+    lease_owner = Column(VARCHAR(255))
+    lease_expires = Column(DateTime)
+    attempts = Column(SMALLINT, nullable=False, default=0)  # failed attempts, reset once the book moves on
+    retry_after = Column(DateTime)  # not claimed again before
     updated_time = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     created_time = Column(DateTime, default=datetime.utcnow)
 
@@ -45,21 +98,358 @@ class ModelBooks(BASE):
 
     @staticmethod
     @with_transaction
-    def get_a_book(status=BookStatus.NOT_DOWNLOADED, next_status=BookStatus.DOWNLOADING):
-        model = SESSION.query(ModelBooks).filter(ModelBooks.status == status).with_for_update().order_by(
-            ModelBooks.updated_time).limit(1).one_or_none()
-        if not model:
-            return None
+    def claim_books(limit, status=BookStatus.NOT_DOWNLOADED, next_status=BookStatus.DOWNLOADING,
+                    owner=None, lease_seconds=None):
+        """Move up to `limit` books from `status` to `next_status`, the ones waiting longest first
+
+        Rows locked by another worker claiming at the same time are skipped
+        instead of waited for, so workers don't queue up behind each other.
+        The partial index on `updated_time` for `status` keeps it from
+        scanning the table.
+
+        The books are leased to `owner` for `lease_seconds`, see `heartbeat`.
+        Books whose lease expired are returned to the queue first. Books still
+        backing off from a failed attempt, or which failed too often, are left
+        alone, see `finish`.
+        """
+        if limit <= 0:
+            return []
+        ModelBooks.reclaim_expired()
+
+        models = SESSION.query(ModelBooks).filter(
+            ModelBooks.status == status,
+            ModelBooks.attempts < safaribooks.settings.BOOK_MAX_ATTEMPTS,
+            or_(ModelBooks.retry_after.is_(None), ModelBooks.retry_after <= datetime.utcnow()),
+        ).with_for_update(skip_locked=True).order_by(ModelBooks.updated_time).limit(limit).all()
+        lease_expires = datetime.utcnow() + timedelta(
+            seconds=lease_seconds or safaribooks.settings.BOOK_LEASE_SECONDS)
+        for model in models:
+            model.status = next_status
+            if next_status in LEASED_STATUSES:
+                model.lease_owner = owner or lease_owner()
+                model.lease_expires = lease_expires
+        SESSION.flush()
+        return models
+
+    @staticmethod
+    @with_transaction
+    def heartbeat(safari_book_ids, owner=None, lease_seconds=None):
+        """Extend the lease of `owner` on the books of `safari_book_ids`
+
+        :return: the ids of the books still leased to `owner`, fewer than
+            asked if a lease expired and the book was reclaimed meanwhile.
+        :rtype: set
+        """
+        if not safari_book_ids:
+            return set()
+        stmt = ModelBooks.__table__.update().where(
+            ModelBooks.safari_book_id.in_(list(safari_book_ids))
+        ).where(
+            ModelBooks.status.in_(list(LEASED_STATUSES))
+        ).where(
+            ModelBooks.lease_owner == (owner or lease_owner())
+        ).values(
+            lease_expires=datetime.utcnow() + timedelta(
+                seconds=lease_seconds or safaribooks.settings.BOOK_LEASE_SECONDS),
+        ).returning(ModelBooks.safari_book_id)
+        return set(book_id for book_id, in SESSION.execute(stmt))
+
+    @staticmethod
+    @with_transaction
+    def reclaim_expired():
+        """Return the books whose lease expired, their worker died, to the status they were claimed from
 
-        model.status = next_status
+        Only the leased rows are looked at, through the partial index on
+        `lease_expires`.
+        """
+        models = SESSION.query(ModelBooks).filter(
+            ModelBooks.status.in_(list(LEASED_STATUSES)),
+            ModelBooks.lease_expires < datetime.utcnow(),
+        ).with_for_update(skip_locked=True).all()
+        for model in models:
+            logger.warning('Reclaim {}, lease of {} expired at {}'.format(
+                model.safari_book_id, model.lease_owner, model.lease_expires))
+            model.status = LEASED_STATUSES[model.status]
+            model.lease_owner = None
+            model.lease_expires = None
         SESSION.flush()
-        return model
+        for status in set(model.status for model in models):
+            notify_status(status)
+        return [model.safari_book_id for model in models]
+
+    @staticmethod
+    def get_a_book(status=BookStatus.NOT_DOWNLOADED, next_status=BookStatus.DOWNLOADING):
+        models = ModelBooks.claim_books(1, status=status, next_status=next_status)
+        return models[0] if models else None
 
     @staticmethod
     @with_transaction
-    def finish(safari_book_id, status=BookStatus.DOWNLOADED):
-        model = SESSION.query(ModelBooks).filter(ModelBooks.safari_book_id == safari_book_id).one_or_none()
+    def finish(safari_book_id, status=BookStatus.DOWNLOADED, owner=None, failed=False):
+        """Move the book to `status` and release its lease
+
+        A book leased to another worker is left alone, this one lost it when
+        the lease expired.
+
+        With `failed`, the attempt is counted and the book is only claimed
+        again after `BOOK_RETRY_DELAY`, doubled on every failed attempt, up
+        to `BOOK_MAX_ATTEMPTS` attempts. Otherwise the count is reset.
+
+        :return: True if the book was moved.
+        """
+        model = SESSION.query(ModelBooks).filter(
+            ModelBooks.safari_book_id == safari_book_id
+        ).with_for_update().one_or_none()
         if not model:
-            return
+            return False
+        if model.lease_owner is not None and model.lease_owner != (owner or lease_owner()):
+            logger.warning('Not finishing {}, it is leased to {}'.format(safari_book_id, model.lease_owner))
+            return False
         model.status = status
+        model.lease_owner = None
+        model.lease_expires = None
+        if failed:
+            model.attempts += 1
+            if model.attempts >= safaribooks.settings.BOOK_MAX_ATTEMPTS:
+                logger.warning('Giving up {} after {} failed attempts'.format(safari_book_id, model.attempts))
+            model.retry_after = datetime.utcnow() + timedelta(
+                seconds=safaribooks.settings.BOOK_RETRY_DELAY * 2 ** (model.attempts - 1))
+        else:
+            model.attempts = 0
+            model.retry_after = None
         SESSION.flush()
+        # Nothing to claim before `retry_after`, the claim interval finds it.
+        if not failed:
+            notify_status(status)
+        return True
+
+    @staticmethod
+    @with_transaction
+    def upsert(rows):
+        """Insert the books of `rows` in a single statement, merging the tags of the existing ones
+
+        :param list rows: dicts of column values, `safari_book_id` must be unique among them.
+        :return: the `safari_book_id` of the inserted books.
+        :rtype: set
+        """
+        if not rows:
+            return set()
+
+        now = datetime.utcnow()
+        values = []
+        # Rows are locked in the same order by concurrent harvesters.
+        for row in sorted(rows, key=lambda r: r['safari_book_id']):
+            value = book_values(row)
+            value.update(updated_time=now, created_time=now)
+            values.append(value)
+
+        stmt = postgresql.insert(ModelBooks.__table__).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ModelBooks.safari_book_id],
+            set_={'tags': text(MERGE_TAGS.format(tags='excluded.tags'))},
+            # Leave the row alone unless it is missing some of the tags.
+            where=text(MISSING_TAGS.format(tags='excluded.tags')),
+        ).returning(ModelBooks.safari_book_id, literal_column('xmax = 0'))
+
+        inserted = set(book_id for book_id, inserted in SESSION.execute(stmt) if inserted)
+        if inserted:
+            notify_status(BookStatus.NOT_DOWNLOADED)
+        return inserted
+
+    @staticmethod
+    @with_transaction
+    def copy_upsert(rows):
+        """Same as `upsert`, for large batches
+
+        The rows are streamed with `COPY` into a temporary staging table, then
+        merged into `books` with one `INSERT ... SELECT ... ON CONFLICT`.
+        """
+        if not rows:
+            return set()
+
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            row = book_values(row)
+            writer.writerow([
+                json.dumps(row.get(column)) if column in STAGING_JSON_COLUMNS else row.get(column, '')
+                for column in STAGING_COLUMNS
+            ])
+        buf.seek(0)
+
+        SESSION.execute(text(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS books_staging ('
+            'safari_book_id VARCHAR(32) NOT NULL, reviews NUMERIC, rating NUMERIC, popularity NUMERIC, '
+            'report_score NUMERIC, pages NUMERIC, title TEXT, description TEXT, language VARCHAR(255), '
+            'authors JSONB, publishers JSONB, tags JSONB, url VARCHAR(4096), web_url VARCHAR(4096)'
+            ') ON COMMIT DELETE ROWS'
+        ))
+        cursor = SESSION.connection().connection.cursor()
+        cursor.copy_expert(
+            'COPY books_staging ({}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL ({}))'.format(
+                ', '.join(STAGING_COLUMNS), ', '.join(STAGING_TEXT_COLUMNS)),
+            buf,
+        )
+
+        # A missing number is staged as NULL, it defaults to 0 as in `upsert`.
+        values = ', '.join(
+            'CAST(COALESCE({0}, 0) AS INT)'.format(column) if column in STAGING_NUMERIC_COLUMNS else column
+            for column in STAGING_COLUMNS
+        )
+        result = SESSION.execute(text(
+            'INSERT INTO books ({columns}, status, updated_time, created_time) '
+            # Rows are locked in the same order by concurrent harvesters.
+            'SELECT DISTINCT ON (safari_book_id) {values}, :status, :now, :now '
+            'FROM books_staging ORDER BY safari_book_id '
+            'ON CONFLICT (safari_book_id) DO UPDATE SET tags = {merge_tags} WHERE {missing_tags} '
+            'RETURNING safari_book_id, xmax = 0'.format(
+                columns=', '.join(STAGING_COLUMNS), values=values,
+                merge_tags=MERGE_TAGS.format(tags='excluded.tags'), missing_tags=MISSING_TAGS.format(tags='excluded.tags'),
+            )
+        ), {'status': BookStatus.NOT_DOWNLOADED, 'now': datetime.utcnow()})
+        inserted = set(book_id for book_id, inserted in result if inserted)
+        if inserted:
+            notify_status(BookStatus.NOT_DOWNLOADED)
+        return inserted
+
+    @staticmethod
+    @with_transaction
+    def existing_ids(safari_book_ids):
+        """Return the ids among `safari_book_ids` which are in `books` already"""
+        if not safari_book_ids:
+            return set()
+        rows = SESSION.query(ModelBooks.safari_book_id).filter(
+            ModelBooks.safari_book_id.in_(list(safari_book_ids))
+        ).all()
+        return set(book_id for book_id, in rows)
+
+    @staticmethod
+    @with_transaction
+    def merge_tags(tags, safari_book_ids):
+        """Add `tags` to the existing books of `safari_book_ids` in one statement
+
+        :return: the ids which are not in `books`, they have to be upserted.
+        :rtype: set
+        """
+        if not safari_book_ids:
+            return set()
+
+        result = SESSION.execute(text(
+            'WITH ids AS (SELECT unnest(CAST(:ids AS VARCHAR[])) AS safari_book_id), '
+            'merged AS ('
+            'UPDATE books SET tags = {merge_tags} '
+            'WHERE books.safari_book_id IN (SELECT safari_book_id FROM ids) AND {missing_tags}) '
+            'SELECT safari_book_id FROM ids '
+            'WHERE NOT EXISTS (SELECT 1 FROM books WHERE books.safari_book_id = ids.safari_book_id)'.format(
+                merge_tags=MERGE_TAGS.format(tags='CAST(:tags AS JSONB)'),
+                missing_tags=MISSING_TAGS.format(tags='CAST(:tags AS JSONB)'),
+            )
+        ), {'ids': sorted(safari_book_ids), 'tags': json.dumps(list(tags))})
+        return set(book_id for book_id, in result)
+
+
+def book_values(row):
+    """Return the column values of the book `row`, the missing and null ones set to their default
+
+    Both `ModelBooks.upsert` and `ModelBooks.copy_upsert` write rows through
+    it, so they accept the same rows, e.g. a search result without a title.
+    """
+    values = {column.name: column.default.arg for column in ModelBooks.__table__.columns
+              if column.default is not None and not callable(column.default.arg)}
+    values.update((column, value) for column, value in row.items() if value is not None)
+    return values
+
+
+class ModelSearchCursors(BASE):
+    __tablename__ = 'search_cursors'
+
+    query = Column(TEXT, primary_key=True)
+    sort = Column(VARCHAR(64), primary_key=True)
+    shard = Column(TEXT, primary_key=True, default='')  # facet filter, e.g. `publishers=...`, empty for none
+    last_page = Column(Integer)  # last page of the contiguous run of pages saved in books
+    total = Column(Integer)
+    updated_time = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_time = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<ModelSearchCursors(query={!r}, sort={!r}, shard={!r}, last_page={})>".format(
+            self.query, self.sort, self.shard, self.last_page)
+
+    @staticmethod
+    @with_transaction
+    def start_page(query, sort, shard=''):
+        """Return the page to resume harvesting `query` sorted by `sort` from"""
+        model = SESSION.query(ModelSearchCursors).filter(
+            ModelSearchCursors.query == query, ModelSearchCursors.sort == sort, ModelSearchCursors.shard == shard
+        ).one_or_none()
+        if not model or model.last_page is None:
+            return 0
+        return model.last_page + 1
+
+    @staticmethod
+    @with_transaction
+    def save_all(cursors):
+        """Record that every page of each search up to its `last_page` is saved, in a single statement
+
+        A cursor never moves backwards, so a harvester resumed on another
+        host does not undo the progress of a faster one.
+
+        :param list cursors: dicts of `query`, `sort`, `shard`, `last_page` and `total`.
+        """
+        if not cursors:
+            return
+
+        # A row can only be updated once by the statement, keep the furthest cursor of each.
+        latest = {}
+        for cursor in cursors:
+            key = (cursor['query'], cursor['sort'], cursor.get('shard', ''))
+            if key not in latest or cursor['last_page'] > latest[key]['last_page']:
+                latest[key] = cursor
+
+        now = datetime.utcnow()
+        stmt = postgresql.insert(ModelSearchCursors.__table__).values([
+            dict(query=query, sort=sort, shard=shard, last_page=cursor['last_page'], total=cursor.get('total'),
+                 updated_time=now, created_time=now)
+            # Rows are locked in the same order by concurrent harvesters.
+            for (query, sort, shard), cursor in sorted(latest.items())
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ModelSearchCursors.query, ModelSearchCursors.sort, ModelSearchCursors.shard],
+            set_={
+                'last_page': text('GREATEST(search_cursors.last_page, excluded.last_page)'),
+                'total': text('COALESCE(excluded.total, search_cursors.total)'),
+                'updated_time': now,
+            },
+        )
+        SESSION.execute(stmt)
+
+
+class ModelRateBuckets(BASE):
+    __tablename__ = 'rate_buckets'
+
+    name = Column(VARCHAR(255), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_time = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<ModelRateBuckets(name={!r}, tokens={})>".format(self.name, self.tokens)
+
+    @staticmethod
+    @with_transaction
+    def take(name, rate, burst):
+        """Take a token from the bucket `name`, refilled at `rate` per second up to `burst`
+
+        The clock of the database is used, so hosts with skewed clocks agree.
+
+        :return: the tokens left, negative when the token has to be waited for.
+        """
+        result = SESSION.execute(text(
+            'INSERT INTO rate_buckets (name, tokens, updated_time) '
+            "VALUES (:name, :burst - 1, clock_timestamp() AT TIME ZONE 'UTC') "
+            'ON CONFLICT (name) DO UPDATE SET '
+            'tokens = LEAST(:burst, rate_buckets.tokens + :rate * EXTRACT(EPOCH FROM '
+            "(clock_timestamp() AT TIME ZONE 'UTC') - rate_buckets.updated_time)) - 1, "
+            "updated_time = clock_timestamp() AT TIME ZONE 'UTC' "
+            'RETURNING tokens'
+        ), {'name': name, 'rate': rate, 'burst': burst})
+        tokens, = result.fetchone()
+        return tokens
@@ -3,13 +3,6 @@ import glob
 import os
 import subprocess
 import logging
-from time import sleep
-import multiprocessing as mp
-
-from scrapy.crawler import CrawlerProcess
-from scrapy.utils.project import get_project_settings
-
-from common.models import ModelBooks
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -20,7 +13,19 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+def read_queries(path):
+    """Return the queries listed in `path`, one per line, skipping blank lines and `#` comments"""
+    with open(path) as fp:
+        lines = [line.strip() for line in fp]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
 def download_epub(args):
+    # Scrapy is only loaded by the commands which crawl, so `--help` and
+    # `convert-to-mobi` start fast.
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
     if not args.user and not args.cookie:
         raise ValueError('argument -u/--user or -c/--cookie is required for downloading')
     if not args.password and args.user:
@@ -33,40 +38,30 @@ def download_epub(args):
         with open(args.cookie) as fp:
             cookie = fp.read()
 
-    def _crawl():
-        if args.loop:
-            book = ModelBooks.get_a_book()
-            if not book:
-                logger.info('There is no book in DB')
-                return
-            book_id = book.safari_book_id
-        else:
-            book_id = str(args.book_id) if args.book_id else None
-
-        logger.info('Start scraping, book_id: {}'.format(book_id))
-        process = CrawlerProcess(get_project_settings())
-        ret = process.crawl(
-            'SafariBooks',
-            user=args.user,
-            password=args.password,
-            cookie=cookie,
-            book_id=book_id,
-            output_directory=args.output_directory,
-            query=args.query
-        )
-        process.start()
-        logger.info('Finish scraping, book_id: {}, ret: {}'.format(book_id, ret))
-
-    while True:
-        p = mp.Process(target=_crawl)
-        p.start()
-        logger.info('Start process, {}'.format(p.pid))
-        p.join()
-        logger.info('Finish process, {}'.format(p.pid))
-        sleep(1)
-
-        if not args.loop:
-            break
+    queries = list(args.query or [])
+    if args.query_file:
+        queries.extend(read_queries(args.query_file))
+
+    # With `--loop` a single crawler stays up, logs in once and keeps
+    # claiming books from DB, see `SafariBooksSpider.spider_idle`.
+    book_id = str(args.book_id) if args.book_id and not args.loop else None
+
+    logger.info('Start scraping, book_id: {}, loop: {}'.format(book_id, args.loop))
+    process = CrawlerProcess(get_project_settings())
+    ret = process.crawl(
+        'SafariBooks',
+        user=args.user,
+        password=args.password,
+        cookie=cookie,
+        book_id=book_id,
+        output_directory=args.output_directory,
+        queries=queries,
+        loop=args.loop,
+        refresh=args.refresh,
+        shard_by=args.shard_by
+    )
+    process.start()
+    logger.info('Finish scraping, book_id: {}, ret: {}'.format(book_id, ret))
 
 
 def convert_to_mobi(args):
@@ -130,12 +125,28 @@ parser.add_argument(
 parser.add_argument(
     '-q',
     '--query',
-    help='Query conditions',
+    help='Query conditions, can be repeated to harvest several queries at once',
+    action='append',
+)
+parser.add_argument(
+    '--query-file',
+    help='File of queries to harvest, one per line',
+)
+parser.add_argument(
+    '-r',
+    '--refresh',
+    help='Only harvest the books added since the last harvest of the queries',
+    action="store_true"
+)
+parser.add_argument(
+    '--shard-by',
+    help='Harvest each query as one shard per value of this search facet',
+    choices=['topics', 'publishers', 'languages'],
 )
 parser.add_argument(
     '-l',
     '--loop',
-    help='Query conditions',
+    help='Keep downloading books claimed from DB',
     action="store_true"
 )
 
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+from scrapy.utils.project import data_path
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+class AssetCache(object):
+    """Content addressed store for assets shared between books.
+
+    Bodies are stored once per sha1 digest under ``objects/``, and an index
+    maps every url to its digest and the validators (``ETag`` /
+    ``Last-Modified``) it was served with. The index is a sqlite database so
+    that several downloader processes on one host can share the cache. Once
+    the stored bodies grow over `max_size` bytes, the least recently used ones
+    are evicted.
+    """
+
+    def __init__(self, directory, max_size, max_age):
+        self.directory = utils.mkdirp(directory)
+        self.max_size = max_size
+        self.max_age = max_age
+        self._db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS urls ('
+                'url TEXT PRIMARY KEY, digest TEXT NOT NULL, etag TEXT, last_modified TEXT, '
+                'fetched_time REAL NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS blobs ('
+                'digest TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed_time REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS urls_digest ON urls (digest)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS blobs_accessed_time ON blobs (accessed_time)')
+        utils.track_lru_size(self._db, 'blobs')
+
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings.getbool('ASSET_CACHE_ENABLED'):
+            return None
+        return cls(
+            data_path(settings.get('ASSET_CACHE_DIR')),
+            settings.getint('ASSET_CACHE_MAX_SIZE'),
+            settings.getint('ASSET_CACHE_MAX_AGE'),
+        )
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def _entry(self, url):
+        return self._db.execute(
+            'SELECT digest, etag, last_modified, fetched_time FROM urls WHERE url = ?', (url,)
+        ).fetchone()
+
+    def _read(self, digest):
+        try:
+            with open(self._blob_path(digest), 'rb') as fh:
+                body = fh.read()
+        except IOError:
+            return None
+        with self._db:
+            self._db.execute('UPDATE blobs SET accessed_time = ? WHERE digest = ?', (time.time(), digest))
+        return body
+
+    def get(self, url, fresh=True):
+        """Return the cached body of `url`, or None
+
+        :param bool fresh: Only return bodies fetched less than `max_age` seconds ago.
+        """
+        entry = self._entry(url)
+        if entry is None:
+            return None
+        digest, _, _, fetched_time = entry
+        if fresh and time.time() - fetched_time > self.max_age:
+            return None
+        return self._read(digest)
+
+    def validators(self, url):
+        """Return the headers to revalidate a stale entry of `url`"""
+        entry = self._entry(url)
+        if entry is None:
+            return {}
+        _, etag, last_modified, _ = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def revalidated(self, url):
+        """Mark the entry of `url` as fresh again, after a `304 Not Modified`"""
+        with self._db:
+            self._db.execute('UPDATE urls SET fetched_time = ? WHERE url = ?', (time.time(), url))
+        return self.get(url, fresh=False)
+
+    def put(self, url, body, etag=None, last_modified=None):
+        """Store `body` as the content of `url` and return its digest"""
+        digest = hashlib.sha1(body).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            utils.mkdirp(os.path.dirname(path))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(body)
+            os.rename(tmp_path, path)
+
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO blobs (digest, size, accessed_time) VALUES (?, ?, ?)',
+                (digest, len(body), now)
+            )
+            self._db.execute(
+                'INSERT OR REPLACE INTO urls (url, digest, etag, last_modified, fetched_time) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (url, digest, etag, last_modified, now)
+            )
+        self.evict()
+        return digest
+
+    def evict(self):
+        """Drop least recently used bodies until the cache fits in `max_size`"""
+        evicted = utils.evict_lru(
+            self._db, 'blobs', 'digest', self.max_size, cascade=['DELETE FROM urls WHERE digest = ?'])
+        if not evicted:
+            return
+
+        for digest in evicted:
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+        logger.info('Evicted {} assets from {}'.format(len(evicted), self.directory))
+
+    def close(self):
+        self._db.close()
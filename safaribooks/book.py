@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import posixpath
+import re
+
+from jinja2 import Template
+
+from common.models import ModelBooks, BookStatus
+from . import utils
+from .epub import EpubWriter
+
+logger = logging.getLogger(__name__)
+
+COVER_PATH = 'cover-image.jpg'
+
+
+class Book(object):
+    """State of a single book being crawled.
+
+    The spider can crawl several books in one run (see ``--loop``), so
+    everything that belongs to one book lives here instead of on the spider.
+
+    What has been fetched is kept in a manifest next to the unfinished epub,
+    ``<book_id>.manifest.json``: the toc, the page json of every toc item and
+    the files which failed for good. Together with the entries of the epub it
+    tells what is still missing, so a book interrupted part way is resumed
+    instead of downloaded again, and it only counts as downloaded once
+    nothing is missing.
+    """
+
+    def __init__(self, book_id, output_directory, checkpoint_entries=50):
+        self.book_id = book_id
+        self.output_directory = output_directory
+        self.checkpoint_entries = checkpoint_entries
+        self.book_name = ''
+        self.book_title = ''
+        self._claimed = set()
+        self._unsaved_entries = 0
+        # Order the book was started in by the spider, and its requests not
+        # answered yet, the book is finished once there are none.
+        self.sequence = 0
+        self.pending = 0
+        # Index of the next toc item to request, see `SafariBooksSpider.item_requests`.
+        self.next_item = 0
+        self.toc = None
+        self.pages = {}
+        self.failed = set()
+        # Set once the lease on the book is lost, see `drop`.
+        self.dropped = False
+        self.epub_path = os.path.join(
+            self.output_directory, '{0}.epub'.format(self.book_id),
+        )
+        self.manifest_path = os.path.join(
+            self.output_directory, '{0}.manifest.json'.format(self.book_id),
+        )
+        self.epub = EpubWriter(self.epub_path)
+        self._load_manifest()
+        logger.info('Writing {0}'.format(self.epub.part_path))
+
+    def __repr__(self):
+        return '<Book(book_id={})>'.format(self.book_id)
+
+    @property
+    def stage_toc(self):
+        return self.toc is not None
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path) as fh:
+                manifest = json.load(fh)
+        except ValueError:
+            logger.warning('Ignore broken manifest {}'.format(self.manifest_path))
+            return
+        if manifest.get('toc') is not None:
+            self.set_toc(manifest['toc'])
+        self.pages = manifest.get('pages', {})
+        self.failed = set(manifest.get('failed', []))
+
+    def _save_manifest(self):
+        manifest = {
+            'toc': self.toc,
+            'pages': self.pages,
+            'failed': sorted(self.failed),
+        }
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(manifest, fh)
+        os.rename(tmp_path, self.manifest_path)
+
+    def _remove_manifest(self):
+        try:
+            os.remove(self.manifest_path)
+        except OSError:
+            pass
+
+    def checkpoint(self):
+        """Persist the epub and the manifest, so they agree with each other"""
+        self.epub.checkpoint()
+        self._save_manifest()
+        self._unsaved_entries = 0
+
+    def has(self, path):
+        """Return True if the file at `path`, relative to OEBPS, is fetched or failed for good"""
+        path = posixpath.normpath(path)
+        return path in self.failed or self.epub.has_oebps(path)
+
+    def write(self, path, data):
+        """Add the file at `path`, relative to OEBPS, to the epub"""
+        if self.dropped:
+            return False
+        written = self.epub.write_oebps(posixpath.normpath(path), data)
+        if written:
+            self._unsaved_entries += 1
+            if self._unsaved_entries >= self.checkpoint_entries:
+                self.checkpoint()
+        return written
+
+    def fail(self, path):
+        """Record that the file at `path` can not be fetched, the book is finished without it"""
+        self.failed.add(posixpath.normpath(path))
+
+    def fail_item(self, url):
+        """Record that the page json of the toc item `url` can not be fetched"""
+        self.failed.add(url)
+
+    def claim(self, path):
+        """Return True the first time the file at `path` is asked for, unless it is fetched already"""
+        path = posixpath.normpath(path)
+        if path in self._claimed or self.has(path):
+            return False
+        self._claimed.add(path)
+        return True
+
+    def add_stylesheet(self, path, data):
+        self.write(path, data)
+
+    @property
+    def stylesheets(self):
+        """Style sheets shared by the pages, they are listed in `content.opf`"""
+        paths = set()
+        for page in self.pages.values():
+            for style_sheet in page['stylesheets']:
+                path = posixpath.normpath(style_sheet['full_path'])
+                if self.epub.has_oebps(path):
+                    paths.add(path)
+        return sorted(paths)
+
+    def set_toc(self, toc):
+        self.toc = toc
+
+        self.book_name = toc['title_safe']
+        book_title = re.sub(r'["%*/:<>?\\|~\s]', r'_', toc['title'])  # to be used for filename
+        self.book_title = "".join([ch for ch in book_title if 32 <= ord(ch) <= 128])
+
+    def set_page(self, url, page_json):
+        """Record the page json fetched for the toc item `url`, return what is kept of it"""
+        self.pages[url] = {
+            'content': page_json['content'],
+            'full_path': page_json['full_path'],
+            # fix for books which are one level down
+            'images': [img.replace('../', '') for img in page_json['images'] if img],
+            'stylesheets': [
+                {'url': style_sheet['url'], 'full_path': style_sheet['full_path']}
+                for style_sheet in page_json.get('stylesheets', [])
+            ],
+        }
+        return self.pages[url]
+
+    def missing(self):
+        """Return the toc items and files which are neither fetched nor failed for good"""
+        if self.toc is None:
+            return ['toc']
+
+        missing = []
+        if not self.has(COVER_PATH):
+            missing.append(COVER_PATH)
+        for item in self.toc['items']:
+            page = self.pages.get(item['url'])
+            if page is None:
+                if item['url'] not in self.failed:
+                    missing.append(item['url'])
+                continue
+            paths = [page['full_path']] + page['images'] + [s['full_path'] for s in page['stylesheets']]
+            missing.extend(path for path in paths if not self.has(path))
+        return missing
+
+    def _render_templates(self):
+        for name in ('content.opf', 'toc.ncx'):
+            with open(utils.pkg_path(os.path.join('data', 'OEBPS', name))) as fh:
+                template = Template(fh.read())
+            self.write(name, template.render(info=self.toc, stylesheets=self.stylesheets))
+
+    def drop(self):
+        """Stop writing the book, leaving its files and its status in DB to the worker it was reclaimed by"""
+        self.dropped = True
+        self.epub.release()
+        logger.warning('Dropped {}, the lease on it was lost'.format(self.book_id))
+
+    def finish(self):
+        """Close the epub and record the result in DB"""
+        if self.stage_toc is False:
+            logger.info(
+                'Did not even got toc, ignore generated file operation, book_id: {}'.format(self.book_id)
+            )
+            self.epub.abort()
+            self._remove_manifest()
+            ModelBooks.finish(self.book_id, BookStatus.NOT_DOWNLOADED, failed=True)
+            return
+
+        missing = self.missing()
+        if missing:
+            # Keep what is fetched, the next attempt only fetches the rest.
+            self.epub.suspend()
+            self._save_manifest()
+            logger.info('Incomplete book, book_id: {}, {} missing, e.g. {}'.format(
+                self.book_id, len(missing), missing[:5]))
+            ModelBooks.finish(self.book_id, BookStatus.NOT_DOWNLOADED, failed=True)
+            return
+
+        if self.failed:
+            logger.warning('Finish book without {} failed files, book_id: {}'.format(len(self.failed), self.book_id))
+        self._render_templates()
+        self.epub.close()
+        self._remove_manifest()
+        logger.info('Made epub {0}'.format(self.epub_path))
+        ModelBooks.finish(self.book_id)
@@ -0,0 +1,144 @@
+import logging
+import time
+
+from twisted.internet import task
+
+from common.models import ModelBooks
+from .seen import seen_set
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogWriter(object):
+    """Buffer search results and write them to `books` in batches.
+
+    Rows are kept in memory until `flush_rows` of them are buffered, or the
+    oldest one has waited `flush_interval` seconds, or the spider closes.
+    Large batches are streamed with ``COPY`` into a staging table and merged
+    in one statement, small ones go through a plain multi row upsert.
+
+    The callbacks given to `add` run once the rows are committed, so a
+    checkpoint moved from them never covers results which are only buffered.
+    `after_flush` runs once they all did, to save what they moved at once.
+
+    Books written already in this run, as found by another query, only need
+    their tags merged. `seen` remembers their ids, and they are flushed with
+    one ``UPDATE`` per set of tags instead of being upserted again. It may be
+    a Bloom filter, so a book it wrongly claims to know is upserted in full
+    once the merge finds it is not in `books`.
+    """
+
+    def __init__(self, flush_rows=500, flush_interval=10, copy_min_rows=100, seen=None, after_flush=None):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.copy_min_rows = copy_min_rows
+        self.seen = seen if seen is not None else set()
+        self.after_flush = after_flush
+        self._rows = {}
+        self._known = {}
+        self._on_flush = []
+        self._oldest = None
+        self._timer = None
+
+    @classmethod
+    def from_settings(cls, settings, after_flush=None):
+        return cls(
+            settings.getint('CATALOG_FLUSH_ROWS'),
+            settings.getfloat('CATALOG_FLUSH_INTERVAL'),
+            settings.getint('CATALOG_COPY_MIN_ROWS'),
+            seen_set(
+                settings.getint('CATALOG_SEEN_BLOOM_CAPACITY'),
+                settings.getfloat('CATALOG_SEEN_BLOOM_ERROR_RATE'),
+            ),
+            after_flush,
+        )
+
+    def __len__(self):
+        return len(self._rows) + len(self._known)
+
+    def start(self):
+        if self._timer is None and self.flush_interval > 0:
+            self._timer = task.LoopingCall(self._flush_if_stale)
+            self._timer.start(min(self.flush_interval, 1), now=False)
+
+    def add(self, rows, on_flush=None):
+        """Buffer `rows`, a list of `books` column dicts
+
+        The same book found by several pages is written once, with the union
+        of their tags.
+        """
+        for row in rows:
+            book_id = row['safari_book_id']
+            buffered = self._rows.get(book_id) or self._known.get(book_id)
+            if buffered is not None:
+                buffered['tags'] = buffered['tags'] + [tag for tag in row['tags'] if tag not in buffered['tags']]
+            elif book_id in self.seen:
+                self._known[book_id] = dict(row)
+            else:
+                self._rows[book_id] = dict(row)
+        if on_flush is not None:
+            self._on_flush.append(on_flush)
+        if self._oldest is None:
+            self._oldest = time.time()
+
+        if len(self) >= self.flush_rows:
+            self.flush()
+
+    def _flush_if_stale(self):
+        if self._oldest is not None and time.time() - self._oldest >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows, return the ids of the new books
+
+        If the write fails the rows stay buffered, and their callbacks
+        pending, so the next flush tries them again. The error is logged
+        instead of raised, the harvest goes on in the meantime.
+        """
+        rows, self._rows = self._rows, {}
+        known, self._known = self._known, {}
+        on_flush, self._on_flush = self._on_flush, []
+        self._oldest = None
+
+        try:
+            inserted = self._write(list(rows.values()), known)
+        except Exception:
+            logger.exception('Failed saving {} books, keeping them for the next flush'.format(len(rows) + len(known)))
+            self._rows.update(rows)
+            self._known.update(known)
+            self._on_flush = on_flush + self._on_flush
+            # Retried by the next add over `flush_rows`, or once the interval passed again.
+            self._oldest = time.time()
+            return set()
+
+        for callback in on_flush:
+            callback()
+        if self.after_flush is not None:
+            self.after_flush()
+        return inserted
+
+    def _write(self, rows, known):
+        by_tags = {}
+        for row in known.values():
+            by_tags.setdefault(tuple(sorted(row['tags'])), []).append(row['safari_book_id'])
+        for tags, book_ids in sorted(by_tags.items()):
+            missing = ModelBooks.merge_tags(tags, book_ids)
+            rows.extend(known[book_id] for book_id in missing)
+        if known:
+            logger.info('Merged tags of {} books'.format(len(known)))
+
+        inserted = set()
+        if rows:
+            if len(rows) >= self.copy_min_rows:
+                inserted = ModelBooks.copy_upsert(rows)
+            else:
+                inserted = ModelBooks.upsert(rows)
+            logger.info('Saved {} books, {} new'.format(len(rows), len(inserted)))
+            self.seen.update(row['safari_book_id'] for row in rows)
+        return inserted
+
+    def close(self):
+        if self._timer is not None and self._timer.running:
+            self._timer.stop()
+        self._timer = None
+        self.flush()
@@ -0,0 +1,155 @@
+import logging
+import os
+import posixpath
+import struct
+import zipfile
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# End of central directory record, without the trailing comment.
+EOCD_FORMAT = '<4s4H2LH'
+EOCD_SIZE = struct.calcsize(EOCD_FORMAT)
+EOCD_SIGNATURE = b'PK\x05\x06'
+
+
+class EpubWriter(object):
+    """Write an epub archive incrementally.
+
+    Entries are added to the archive as soon as they are downloaded, so
+    nothing is staged in a temporary directory. The archive is written to
+    ``<path>.part`` and renamed to ``path`` once it is complete.
+
+    `checkpoint` makes ``<path>.part`` a valid zip file holding every entry
+    written so far, and keeps a copy of its central directory in
+    ``<path>.part.index``. New entries overwrite the central directory at the
+    end of the archive, so if the process dies before the next checkpoint the
+    archive is cut back to the last checkpoint from that copy. An existing
+    ``<path>.part`` is resumed instead of started over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = path + '.part'
+        self.index_path = self.part_path + '.index'
+        self._zip = self._resume()
+        if self._zip is not None:
+            self._names = set(self._zip.namelist())
+            logger.info('Resumed {} with {} entries'.format(self.part_path, len(self._names)))
+            return
+
+        self._names = set()
+        self._zip = zipfile.ZipFile(self.part_path, 'w', zipfile.ZIP_DEFLATED)
+
+        # `mimetype` has to be the first entry and must not be compressed.
+        self.write('mimetype', self._read_data('mimetype'), compress_type=zipfile.ZIP_STORED)
+        self.write('META-INF/container.xml', self._read_data('META-INF/container.xml'))
+
+    @staticmethod
+    def _read_data(relpath):
+        with open(utils.pkg_path(os.path.join('data', relpath)), 'rb') as fh:
+            return fh.read()
+
+    def _resume(self):
+        if not os.path.exists(self.part_path):
+            return None
+        # Mode 'a' appends a new archive to anything which is not a zip file,
+        # so check it can be read first.
+        try:
+            zipfile.ZipFile(self.part_path).close()
+            return zipfile.ZipFile(self.part_path, 'a', zipfile.ZIP_DEFLATED)
+        except zipfile.BadZipfile:
+            pass
+
+        # Died after the last checkpoint, restore the central directory it saved.
+        try:
+            with open(self.index_path, 'rb') as fh:
+                index = fh.read()
+            cd_offset = struct.unpack(EOCD_FORMAT, index[-EOCD_SIZE:])[6]
+            with open(self.part_path, 'r+b') as fh:
+                fh.truncate(cd_offset)
+                fh.seek(cd_offset)
+                fh.write(index)
+            zipfile.ZipFile(self.part_path).close()
+            return zipfile.ZipFile(self.part_path, 'a', zipfile.ZIP_DEFLATED)
+        except (IOError, OSError, struct.error, zipfile.BadZipfile):
+            logger.warning('Can not resume {}, starting over'.format(self.part_path))
+            self._remove(self.part_path)
+            self._remove(self.index_path)
+            return None
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def has_oebps(self, path):
+        return posixpath.join('OEBPS', path) in self._names
+
+    def write(self, name, data, compress_type=zipfile.ZIP_DEFLATED):
+        """Add `data` (bytes or unicode) as entry `name` of the archive
+
+        :return: False if the entry already exists, True otherwise.
+        """
+        if name in self._names:
+            logger.debug('Skip duplicated entry {}, {}'.format(name, self.part_path))
+            return False
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._zip.writestr(name, data, compress_type=compress_type)
+        self._names.add(name)
+        return True
+
+    def write_oebps(self, path, data):
+        return self.write(posixpath.join('OEBPS', path), data)
+
+    def checkpoint(self):
+        """Make the archive on disk hold every entry written so far"""
+        self._zip.close()
+
+        with open(self.part_path, 'rb') as fh:
+            fh.seek(-EOCD_SIZE, os.SEEK_END)
+            eocd = fh.read()
+            signature, _, _, _, _, _, cd_offset, _ = struct.unpack(EOCD_FORMAT, eocd)
+            if signature == EOCD_SIGNATURE:
+                fh.seek(cd_offset)
+                index = fh.read()
+            else:
+                index = None
+
+        if index is not None:
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as fh:
+                fh.write(index)
+            os.rename(tmp_path, self.index_path)
+
+        self._zip = zipfile.ZipFile(self.part_path, 'a', zipfile.ZIP_DEFLATED)
+
+    def suspend(self):
+        """Close the unfinished archive so it can be resumed later"""
+        self.checkpoint()
+        self._zip.close()
+
+    def close(self):
+        """Finish the archive and move it to its final path"""
+        self._zip.close()
+        os.rename(self.part_path, self.path)
+        self._remove(self.index_path)
+
+    def release(self):
+        """Close the archive file without writing anything more to it, another process took it over"""
+        # Closing the `ZipFile` itself would write its central directory.
+        fp, self._zip.fp = self._zip.fp, None
+        fp.close()
+
+    def abort(self):
+        """Drop the unfinished archive"""
+        self._zip.close()
+        self._remove(self.part_path)
+        self._remove(self.index_path)
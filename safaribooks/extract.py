@@ -0,0 +1,153 @@
+"""
+Extract the ``<body>`` of a downloaded page
+"""
+
+import re
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from .utils import decode
+
+# Tags written as `<tag/>` when they have no content, and attributes holding
+# whitespace separated values, as BeautifulSoup's html tree builder knows them.
+EMPTY_ELEMENT_TAGS = frozenset([
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img',
+    'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track',
+    'wbr',
+])
+CDATA_LIST_ATTRIBUTES = {
+    '*': frozenset(['class', 'accesskey', 'dropzone']),
+    'a': frozenset(['rel', 'rev']),
+    'link': frozenset(['rel', 'rev']),
+    'td': frozenset(['headers']),
+    'th': frozenset(['headers']),
+    'form': frozenset(['accept-charset']),
+    'object': frozenset(['archive']),
+    'area': frozenset(['rel']),
+    'icon': frozenset(['sizes']),
+    'iframe': frozenset(['sandbox']),
+    'output': frozenset(['for']),
+}
+# libxml2 fills these in as `checked="checked"` when written bare, which
+# BeautifulSoup keeps as `checked=""`, so the two can't be told apart.
+BOOLEAN_ATTRIBUTES = frozenset([
+    'checked', 'compact', 'declare', 'defer', 'disabled', 'ismap', 'multiple', 'nohref', 'noresize', 'noshade',
+    'nowrap', 'readonly', 'selected',
+])
+# Text of these tags is written without entity substitution.
+CDATA_CONTAINING_TAGS = frozenset(['script', 'style'])
+# Whitespace only text is kept as is within these tags, elsewhere
+# BeautifulSoup collapses it to a single newline or space.
+PRESERVE_WHITESPACE_TAGS = frozenset(['pre', 'textarea'])
+ASCII_SPACES = frozenset('\x20\x0a\x09\x0c\x0d')
+
+DECLARED_ENCODING_RE = re.compile(br'''(?:encoding|charset)\s*=\s*["']?([a-zA-Z0-9_.:-]+)''', re.I)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _quote(value):
+    quote_with = '"'
+    if '"' in value:
+        if "'" in value:
+            value = value.replace('"', '&quot;')
+        else:
+            quote_with = "'"
+    return quote_with + value + quote_with
+
+
+def _collapse(text, preserve):
+    if preserve or not ASCII_SPACES.issuperset(text):
+        return text
+    return '\n' if '\n' in text else ' '
+
+
+def _serialize(element, out, preserve=False):
+    tag = element.tag
+    if tag is etree.Comment:
+        out.append('<!--{}-->'.format(_collapse(element.text, preserve) if element.text else ''))
+        return
+    if not isinstance(tag, str) or tag.startswith('{'):
+        raise _Unsupported(tag)
+
+    out.append('<')
+    out.append(tag)
+    # BeautifulSoup sorts attributes and normalizes the whitespace of
+    # multi valued ones.
+    for key, value in sorted(element.attrib.items()):
+        if key in BOOLEAN_ATTRIBUTES and value == key:
+            raise _Unsupported(key)
+        if key in CDATA_LIST_ATTRIBUTES['*'] or key in CDATA_LIST_ATTRIBUTES.get(tag, ()):
+            value = ' '.join(value.split())
+        out.append(' ')
+        out.append(key)
+        out.append('=')
+        out.append(_quote(_escape(value)))
+
+    if tag in EMPTY_ELEMENT_TAGS and not element.text and not len(element):
+        out.append('/>')
+        return
+
+    out.append('>')
+    escape = tag not in CDATA_CONTAINING_TAGS
+    inner = preserve or tag in PRESERVE_WHITESPACE_TAGS
+    if element.text:
+        text = _collapse(element.text, inner)
+        out.append(_escape(text) if escape else text)
+    for child in element:
+        _serialize(child, out, inner)
+        if child.tail:
+            tail = _collapse(child.tail, inner)
+            out.append(_escape(tail) if escape else tail)
+    out.append('</')
+    out.append(tag)
+    out.append('>')
+
+
+def _soup_body(content):
+    return decode(str(BeautifulSoup(content, 'lxml').find('body')))
+
+
+def extract_body(content):
+    """Return the ``<body>`` element of the html `content` as unicode
+
+    The result is the same as ``str(BeautifulSoup(content, 'lxml').find('body'))``,
+    but the page is parsed by lxml into its C tree and written out directly,
+    without building BeautifulSoup's python objects. Both use the same libxml2
+    html parser, the serialization follows BeautifulSoup's `minimal`
+    formatter and collapses whitespace only text like it does. Pages which are not utf-8, or hold nodes this writer does not
+    know, are handed to BeautifulSoup.
+
+    :param bytes content: The downloaded page.
+    :rtype: str
+    """
+    declared = DECLARED_ENCODING_RE.search(content[:1024])
+    if declared and declared.group(1).lower().replace(b'_', b'-') not in (b'utf-8', b'utf8'):
+        return _soup_body(content)
+    try:
+        content.decode('utf-8')
+    except UnicodeDecodeError:
+        return _soup_body(content)
+
+    parser = etree.HTMLParser(encoding='utf-8', recover=True, strip_cdata=False)
+    try:
+        root = etree.fromstring(content, parser)
+    except etree.LxmlError:
+        return _soup_body(content)
+    body = root.find('.//body') if root is not None else None
+    if body is None:
+        return _soup_body(content)
+
+    out = []
+    try:
+        _serialize(body, out)
+    except (_Unsupported, RuntimeError):
+        return _soup_body(content)
+    return ''.join(out)
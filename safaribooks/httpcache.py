@@ -0,0 +1,120 @@
+"""
+HTTP cache for the toc, page json and content of books
+
+Responses carrying an ``ETag`` or ``Last-Modified`` are stored, and once
+stale the cache middleware asks for them again with ``If-None-Match`` /
+``If-Modified-Since``. A ``304 Not Modified`` is answered from the cache, so
+refreshing a book that did not change upstream mostly costs headers.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+from w3lib.url import canonicalize_url
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+class BookCachePolicy(RFC2616Policy):
+    """RFC 2616 policy, limited to requests flagged with the ``http_cache`` meta key
+
+    Everything else, the search API and the assets which have their own
+    cache, goes to the network untouched.
+    """
+
+    def should_cache_request(self, request):
+        if not request.meta.get('http_cache'):
+            return False
+        return super(BookCachePolicy, self).should_cache_request(request)
+
+    def should_cache_response(self, response, request):
+        if response.status != 200:
+            return False
+        return super(BookCachePolicy, self).should_cache_response(response, request)
+
+
+class SqliteCacheStorage(object):
+    """Cache storage in a single sqlite database, bounded in size
+
+    Once the stored responses grow over ``HTTPCACHE_MAX_SIZE`` bytes, the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings.get('HTTPCACHE_DIR'))
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.max_size = settings.getint('HTTPCACHE_MAX_SIZE')
+        self._db = None
+
+    def open_spider(self, spider):
+        utils.mkdirp(self.cachedir)
+        path = os.path.join(self.cachedir, '{}.sqlite'.format(spider.name))
+        self._db = sqlite3.connect(path, timeout=30)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, url TEXT NOT NULL, status INTEGER NOT NULL, headers BLOB NOT NULL, '
+                'body BLOB NOT NULL, size INTEGER NOT NULL, stored_time REAL NOT NULL, accessed_time REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_time ON responses (accessed_time)')
+        utils.track_lru_size(self._db, 'responses')
+        logger.debug('Using sqlite cache storage in {}'.format(path))
+
+    def close_spider(self, spider):
+        self._db.close()
+
+    @staticmethod
+    def _key(request):
+        key = hashlib.sha1()
+        key.update(request.method.encode('utf-8'))
+        key.update(canonicalize_url(request.url).encode('utf-8'))
+        key.update(request.body or b'')
+        return key.hexdigest()
+
+    def retrieve_response(self, spider, request):
+        key = self._key(request)
+        row = self._db.execute(
+            'SELECT url, status, headers, body, stored_time FROM responses WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        url, status, headers, body, stored_time = row
+        if 0 < self.expiration_secs < time.time() - stored_time:
+            return None
+
+        with self._db:
+            self._db.execute('UPDATE responses SET accessed_time = ? WHERE key = ?', (time.time(), key))
+
+        headers = Headers(headers_raw_to_dict(bytes(headers)))
+        body = bytes(body)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        headers = headers_dict_to_raw(response.headers)
+        size = len(headers) + len(response.body)
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, url, status, headers, body, size, stored_time, accessed_time) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self._key(request), response.url, response.status, sqlite3.Binary(headers),
+                 sqlite3.Binary(response.body), size, now, now)
+            )
+        self._evict()
+
+    def _evict(self):
+        evicted = utils.evict_lru(self._db, 'responses', 'key', self.max_size)
+        if evicted:
+            logger.info('Evicted {} responses from {}'.format(len(evicted), self.cachedir))
@@ -0,0 +1,115 @@
+"""
+Request budget shared by all downloader processes
+
+A token bucket refilled at ``RATE_LIMIT_RATE`` requests per second, holding
+up to ``RATE_LIMIT_BURST`` of them. Every request takes a token, and waits for
+it if the bucket is empty. The bucket lives in a locked file, shared by the
+processes of one host, or in the ``rate_buckets`` table of the database,
+shared by every host.
+"""
+
+import fcntl
+import logging
+import os
+import struct
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.project import data_path
+from twisted.internet import reactor, task
+
+from common.models import ModelRateBuckets
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+BUCKET_FORMAT = '<dd'
+BUCKET_SIZE = struct.calcsize(BUCKET_FORMAT)
+
+
+class FileBucket(object):
+    """Token bucket in a file, updated under an exclusive `flock`"""
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        utils.mkdirp(os.path.dirname(path))
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def take(self):
+        """Take a token, return the seconds to wait before it may be used"""
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            data = os.read(self._fd, BUCKET_SIZE)
+            now = time.time()
+            if len(data) == BUCKET_SIZE:
+                tokens, stamp = struct.unpack(BUCKET_FORMAT, data)
+                tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            else:
+                tokens = self.burst
+            # Tokens go negative, so concurrent takers queue up in order
+            # instead of all retrying at once.
+            tokens -= 1
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            os.write(self._fd, struct.pack(BUCKET_FORMAT, tokens, now))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return max(0.0, -tokens / self.rate)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class DatabaseBucket(object):
+    """Token bucket in a row of `rate_buckets`"""
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def take(self):
+        tokens = ModelRateBuckets.take(self.name, self.rate, self.burst)
+        return max(0.0, -tokens / self.rate)
+
+    def close(self):
+        pass
+
+
+class RateLimit(object):
+    """Downloader middleware delaying requests until the shared bucket has a token for them"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('RATE_LIMIT_ENABLED'):
+            raise NotConfigured
+        rate = settings.getfloat('RATE_LIMIT_RATE')
+        burst = settings.getfloat('RATE_LIMIT_BURST')
+        name = settings.get('RATE_LIMIT_NAME')
+        backend = settings.get('RATE_LIMIT_BACKEND')
+        if backend == 'file':
+            bucket = FileBucket(os.path.join(data_path(settings.get('RATE_LIMIT_DIR')), name), rate, burst)
+        elif backend == 'database':
+            bucket = DatabaseBucket(name, rate, burst)
+        else:
+            raise NotConfigured('Unknown RATE_LIMIT_BACKEND {!r}'.format(backend))
+
+        middleware = cls(bucket)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    async def process_request(self, request, spider):
+        wait = self.bucket.take()
+        if wait > 0:
+            await maybe_deferred_to_future(task.deferLater(reactor, wait, lambda: None))
+
+    def spider_closed(self, spider):
+        self.bucket.close()
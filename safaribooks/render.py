@@ -0,0 +1,128 @@
+"""
+Render downloaded pages into epub xhtml, off the Twisted reactor
+"""
+
+import logging
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from jinja2 import Template
+from twisted.internet import defer
+
+from .extract import extract_body
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STYLE = """
+p.pre {
+  font-family: monospace;
+  white-space: pre;
+}"""
+
+PAGE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+    <head>
+        <title></title>
+        {% for href in stylesheets %}
+        <link rel="stylesheet" type="text/css" href="{{href}}"/>
+        {% endfor %}
+        <style>
+        {{style}}
+        </style>
+    </head>
+    {{body}}
+</html>"""
+
+page_template = Template(PAGE_TEMPLATE)
+
+
+def render_page(content, stylesheets):
+    """Render the body of the downloaded page `content` into an epub page
+
+    :param bytes content: The downloaded html.
+    :param list stylesheets: Paths of the style sheets, relative to the page.
+    :rtype: bytes
+    """
+    body = extract_body(content)
+    return page_template.render(body=body, style=DEFAULT_STYLE, stylesheets=stylesheets).encode('utf-8')
+
+
+class RenderPool(object):
+    """Run `render_page` in a pool of worker processes.
+
+    Parsing a large chapter takes long enough to stall every download when
+    it runs inside a reactor callback, so it is handed to the pool and a
+    `Deferred` of the result is returned instead. With `max_workers` set to
+    0 pages are rendered in-process.
+
+    The workers are not forked from the crawler, whose threads may hold
+    locks at that time, but started by a fork server. When a worker dies the
+    pool is started again and the page is rendered once more.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = self._new_executor() if max_workers else None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('RENDER_POOL_SIZE'))
+
+    def _new_executor(self):
+        if sys.version_info < (3, 7):
+            # No `mp_context` before Python 3.7, the workers are forked.
+            return ProcessPoolExecutor(self.max_workers)
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context(method))
+
+    def _restart(self, executor):
+        # Every render in flight on the broken pool fails, only the first
+        # one to notice starts a new pool.
+        if self._executor is executor:
+            logger.warning('A render worker died, starting the pool again')
+            executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+
+    def render(self, content, stylesheets):
+        """Return a `Deferred` firing with the rendered page"""
+        if self._executor is None:
+            return defer.maybeDeferred(render_page, content, stylesheets)
+
+        d = defer.Deferred()
+        self._submit(d, content, stylesheets, retries=1)
+        return d
+
+    def _submit(self, d, content, stylesheets, retries):
+        from twisted.internet import reactor
+
+        executor = self._executor
+
+        def _fire(future):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                if not retries:
+                    d.errback()
+                    return
+                self._restart(executor)
+                self._submit(d, content, stylesheets, retries - 1)
+            except Exception:
+                d.errback()
+            else:
+                d.callback(result)
+
+        try:
+            future = executor.submit(render_page, content, stylesheets)
+        except BrokenProcessPool:
+            # Broken while an earlier render was in flight, its callback has
+            # not run yet.
+            self._restart(executor)
+            executor = self._executor
+            future = executor.submit(render_page, content, stylesheets)
+        future.add_done_callback(lambda f: reactor.callFromThread(_fire, f))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
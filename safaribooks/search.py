@@ -0,0 +1,189 @@
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+FACET_NAMES = ('topics', 'publishers', 'languages')
+
+
+def facet_counts(response, name):
+    """Return the values of the facet `name` listed in a search `response`, with their counts, largest first
+
+    Facet entries are either plain values, counted as 0, or dicts such as
+    ``{"key": ..., "count": ...}``.
+
+    :rtype: list of (value, count) tuples
+    """
+    counts = []
+    for entry in (response.get('facets') or {}).get(name) or []:
+        if isinstance(entry, dict):
+            value = entry.get('key', entry.get('value', entry.get('name')))
+            count = entry.get('count', 0)
+        else:
+            value, count = entry, 0
+        if value:
+            counts.append((value, count))
+    return sorted(counts, key=lambda c: -c[1])
+
+
+def shard_key(facets):
+    """Key of the facet filter `facets` in `search_cursors`, empty for none"""
+    return '&'.join(
+        '{}={}'.format(name, value)
+        for name in FACET_NAMES for value in sorted((facets or {}).get(name, []))
+    )
+
+
+class Search(object):
+    """State of harvesting the results of one search query.
+
+    Once the first page tells the total, the remaining page numbers are
+    known, so up to `window` pages are kept in flight and they may complete
+    out of order. The checkpoint only moves to the last page of the
+    contiguous run of pages whose results are saved, a resumed harvest never
+    skips a page.
+
+    `facets` narrows the query to a shard, e.g. ``{'publishers': [name]}``,
+    so a huge result set can be harvested as many small ones in parallel.
+
+    With `stop_after`, the results are expected newest first, and the
+    harvest stops once that many pages in a row brought no new book.
+    """
+
+    page_size = 10
+
+    def __init__(self, query, sort, start_page=0, window=8, max_books=None, stop_after=None, facets=None):
+        self.query = query
+        self.sort = sort
+        self.facets = facets or {}
+        self.start_page = start_page
+        self.window = window
+        self.max_books = max_books
+        self.stop_after = stop_after
+        self.total = None
+        self.last_page = None
+        # The results of every page before `low_water` are saved.
+        self.low_water = start_page
+        self._next_page = start_page
+        self._in_flight = set()
+        self._done = set()
+        self._failed = set()
+        # Number of new books of the pages after `_counted`, see `count_new`.
+        self._new = {}
+        self._counted = start_page
+        self._known_run = 0
+
+    def __repr__(self):
+        return '<Search(query={!r}, shard={!r}, low_water={}, last_page={})>'.format(
+            self.query, self.shard, self.low_water, self.last_page)
+
+    @property
+    def shard(self):
+        return shard_key(self.facets)
+
+    def post_body(self, page):
+        return {
+            "query": self.query,
+            "extended_publisher_data": "true",
+            "highlight": "true",
+            "is_academic_institution_account": "false",
+            "source": "user",
+            "include_assessments": "false",
+            "include_case_studies": "true",
+            "include_courses": "true",
+            "include_orioles": "true",
+            "include_playlists": "true",
+            "formats": ["book"],
+            "topics": list(self.facets.get('topics', [])),
+            "publishers": list(self.facets.get('publishers', [])),
+            "languages": list(self.facets.get('languages', [])),
+            "sort": self.sort,
+            "page": page
+        }
+
+    @property
+    def checkpoint(self):
+        """The last page of the contiguous run of completed pages, None if there is none yet"""
+        return self.low_water - 1 if self.low_water > self.start_page else None
+
+    def set_total(self, total):
+        self.total = total
+        if self.max_books is not None:
+            total = min(total, self.max_books)
+        self.last_page = int(math.ceil(float(total) / self.page_size)) - 1
+
+    def next_pages(self):
+        """Return the pages to request now, to keep the window full"""
+        if self.last_page is None:
+            # Only the first page until the total is known.
+            limit = self.start_page
+        else:
+            limit = self.last_page
+
+        pages = []
+        while self._next_page <= limit and len(self._in_flight) < self.window:
+            pages.append(self._next_page)
+            self._in_flight.add(self._next_page)
+            self._next_page += 1
+        return pages
+
+    def fetched(self, page, empty=False):
+        """Mark `page` as downloaded, which frees its place in the window
+
+        :param bool empty: No results on the page, the ones after it are empty too.
+        """
+        self._in_flight.discard(page)
+        if empty and (self.last_page is None or page <= self.last_page):
+            self.last_page = page - 1
+
+    def saved(self, page):
+        """Mark the results of `page` as saved in DB
+
+        Pages past `last_page` are ignored, a resumed harvest has to request
+        them again once the catalog grows.
+
+        :return: True if the checkpoint moved.
+        """
+        if self.last_page is None or page > self.last_page:
+            return False
+        self._done.add(page)
+        moved = False
+        while self.low_water in self._done:
+            self._done.remove(self.low_water)
+            self.low_water += 1
+            moved = True
+        return moved
+
+    def count_new(self, page, new):
+        """Record that `page` brought `new` books not in DB before
+
+        :return: True if the harvest stopped, as `stop_after` pages in a row
+            brought nothing new.
+        """
+        if self.stop_after is None or self._known_run >= self.stop_after:
+            return False
+        self._new[page] = new
+        # Pages complete out of order, count the run in page order.
+        while self._counted in self._new:
+            if self._new.pop(self._counted):
+                self._known_run = 0
+            else:
+                self._known_run += 1
+            if self._known_run >= self.stop_after:
+                if self.last_page is None or self._counted < self.last_page:
+                    self.last_page = self._counted
+                self._new.clear()
+                return True
+            self._counted += 1
+        return False
+
+    def failed(self, page):
+        """Mark `page` as failed, the checkpoint stays before it"""
+        self._in_flight.discard(page)
+        self._failed.add(page)
+        # Whatever it held is unknown, so it breaks a run of known pages.
+        self.count_new(page, 1)
+
+    @property
+    def finished(self):
+        return not self._in_flight and self.last_page is not None and self._next_page > self.last_page
@@ -0,0 +1,58 @@
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    """Set of strings which may wrongly claim to hold a string, never the other way round.
+
+    It takes about 1.2 bytes per string at 1% false positives, against a
+    hundred or so for a python set, so the ids seen by a harvest of the whole
+    catalog fit in a few MB.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _positions(self, key):
+        # Double hashing, the k positions are derived from the two halves of one digest.
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        h1, h2 = struct.unpack('<QQ', digest[:16])
+        h2 |= 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        added = False
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                self._bits[byte] |= 1 << bit
+                added = True
+        if added:
+            self._len += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                return False
+        return True
+
+
+def seen_set(capacity=0, error_rate=0.01):
+    """Return an exact set, or a `BloomFilter` sized for `capacity` strings if it is not 0"""
+    if capacity:
+        return BloomFilter(capacity, error_rate)
+    return set()
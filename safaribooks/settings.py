@@ -9,6 +9,8 @@
 #     http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
 #     http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
 
+import multiprocessing
+
 BOT_NAME = 'safaribooks'
 LOG_LEVEL = 'DEBUG'
 
@@ -23,12 +25,14 @@ NEWSPIDER_MODULE = 'safaribooks.spiders'
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
+# Every endpoint has a download slot of its own, see `safaribooks.throttle`
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See http://scrapy.readthedocs.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
-DOWNLOAD_DELAY = 0.25
+# The delay of every endpoint is set by the adaptive throttle instead
+DOWNLOAD_DELAY = 0
 # The download delay setting will honor only one of:
 #CONCURRENT_REQUESTS_PER_DOMAIN = 16
 #CONCURRENT_REQUESTS_PER_IP = 16
@@ -53,9 +57,11 @@ DOWNLOAD_DELAY = 0.25
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'safaribooks.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'safaribooks.throttle.AdaptiveThrottle': 950,
+    # After the HTTP cache, responses served from it cost no budget
+    'safaribooks.ratelimit.RateLimit': 960,
+}
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
@@ -82,13 +88,98 @@ DOWNLOAD_DELAY = 0.25
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG = False
 
+# Adjust the concurrency and delay of every endpoint (search, toc, page json,
+# content, assets) to how fast and healthy its responses are
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_THROTTLE_START_CONCURRENCY = 2
+ADAPTIVE_THROTTLE_MIN_CONCURRENCY = 1
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = 16
+# Concurrency stops growing once the average latency is over this many seconds
+ADAPTIVE_THROTTLE_TARGET_LATENCY = 2.0
+# Delay after a throttling answer, unless Retry-After asks for more
+ADAPTIVE_THROTTLE_BACKOFF_DELAY = 1.0
+ADAPTIVE_THROTTLE_MAX_DELAY = 60.0
+# The delay is held until Retry-After, or the delay itself, has passed, then
+# shrinks by this factor on every healthy response
+ADAPTIVE_THROTTLE_DELAY_DECAY = 0.9
+ADAPTIVE_THROTTLE_BACKOFF_HTTP_CODES = [429, 503]
+ADAPTIVE_THROTTLE_DEBUG = False
+
+# Request budget of the account, shared by all downloader processes, see
+# `safaribooks.ratelimit`. The `file` backend is shared by the processes of
+# one host, `database` by every host
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_BACKEND = 'file'
+RATE_LIMIT_DIR = 'ratelimit'
+RATE_LIMIT_NAME = 'safaribooks'
+RATE_LIMIT_RATE = 8.0
+RATE_LIMIT_BURST = 16
+
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = 'httpcache'
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+# Only the toc, page json and content of books are cached, see `safaribooks.httpcache`
+HTTPCACHE_ENABLED = True
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = 'httpcache'
+HTTPCACHE_POLICY = 'safaribooks.httpcache.BookCachePolicy'
+HTTPCACHE_STORAGE = 'safaribooks.httpcache.SqliteCacheStorage'
+HTTPCACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# Books crawled at once with --loop, their requests are prioritized so the
+# first one started finishes first
+BOOKS_IN_FLIGHT = 2
+# Requests of a book kept pending at once, the next toc items are requested as
+# they are answered
+BOOK_MAX_PENDING_REQUESTS = 100
+# Books claimed by a downloader or uploader are leased for this many seconds,
+# and the lease is renewed every third of it while the work goes on. A book
+# whose worker died is claimed again once its lease expires
+BOOK_LEASE_SECONDS = 600
+# With --loop, books are claimed as soon as they are announced by NOTIFY, and
+# looked for at least this often in case a notification is missed
+BOOK_CLAIM_INTERVAL = 60
+# A book left incomplete is claimed again after this many seconds, doubled on
+# every failed attempt, and no more once it failed that many times
+BOOK_RETRY_DELAY = 600
+BOOK_MAX_ATTEMPTS = 5
+
+# Search result pages kept in flight while harvesting a query
+SEARCH_CONCURRENT_PAGES = 8
+
+# With --refresh, a query stops after this many pages in a row of books
+# which are all in DB already
+SEARCH_REFRESH_KNOWN_PAGES = 3
+
+# Search results are buffered and written to DB once this many books are
+# buffered, or the oldest one has waited this many seconds
+CATALOG_FLUSH_ROWS = 500
+CATALOG_FLUSH_INTERVAL = 10
+# Batches from this size on are loaded with COPY instead of a multi row INSERT
+CATALOG_COPY_MIN_ROWS = 100
+# Books already saved by one query only get the tags of the others merged.
+# They are remembered in a set, or in a Bloom filter sized for this many books
+# if it is not 0, for harvests too large to keep every id in memory
+CATALOG_SEEN_BLOOM_CAPACITY = 0
+CATALOG_SEEN_BLOOM_ERROR_RATE = 0.01
+
+# Content addressed cache of stylesheets and images, shared by all books and
+# all downloader processes on the host
+ASSET_CACHE_ENABLED = True
+ASSET_CACHE_DIR = 'assetcache'
+ASSET_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+# Entries older than this are revalidated with `If-None-Match` / `If-Modified-Since`
+ASSET_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Unfinished epubs and their manifests are saved every this many files, an
+# interrupted book is resumed from there
+BOOK_CHECKPOINT_ENTRIES = 50
+
+# Number of worker processes that parse and render pages, 0 renders them in
+# the crawler process
+RENDER_POOL_SIZE = multiprocessing.cpu_count()
+# Downloads back off while this many bytes of responses wait to be processed,
+# which includes the pages queued in the render pool
+SCRAPER_SLOT_MAX_ACTIVE_SIZE = 5000000
 
 DATABASE = {
     'ENGINE': 'pg',
@@ -99,3 +190,11 @@ DATABASE = {
     'PORT': '5432',
     'OPTIONS': {'autocommit': True},
 }
+
+# Connections kept by every process, they are opened on first use
+DATABASE_POOL_SIZE = 1
+DATABASE_POOL_TIMEOUT = 30
+# Seconds before a connection is replaced, -1 to keep it
+DATABASE_POOL_RECYCLE = -1
+# Milliseconds a statement may run
+DATABASE_STATEMENT_TIMEOUT = 5000
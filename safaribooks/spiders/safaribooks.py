@@ -1,36 +1,26 @@
-import codecs
 import json
-import os
+import posixpath
 import re
-import shutil
 import tempfile
+import time
 from functools import partial
 
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import defer, task
 # from scrapy.shell import inspect_response
-from jinja2 import Template
-from bs4 import BeautifulSoup
 
-from common.db_session import SESSION, with_transaction
-from common.models import ModelBooks, BookStatus
+from common.listener import StatusListener
+from common.models import BookStatus, ModelBooks, ModelSearchCursors
 from .. import utils
-
-DEFAULT_STYLE = """
-p.pre {
-  font-family: monospace;
-  white-space: pre;
-}"""
-
-PAGE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
-    <head>
-        <title></title>
-        <style>
-        {{style}}
-        </style>
-    </head>
-    {{body}}
-</html>"""
+from ..asset_cache import AssetCache
+from ..book import Book, COVER_PATH
+from ..catalog import CatalogWriter
+from ..render import RenderPool
+from ..search import Search, facet_counts, shard_key
 
 
 # def url_base(u):
@@ -42,12 +32,6 @@ PAGE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 #     idx = len(u)
 #   return u[:idx]
 
-def decode(s):
-    try:
-        return s.decode("utf8")
-    except:
-        return s
-
 
 class SafariBooksSpider(scrapy.spiders.Spider):
     search_url = 'https://www.safaribooksonline.com/api/v2/search/'
@@ -59,7 +43,9 @@ class SafariBooksSpider(scrapy.spiders.Spider):
     MAX_NUMBER_OF_BOOKS = 1000000
     sort_by_score = "report_score"
     sort_by_relevance = "relevance"
-    page_file = '.page'
+    sort_by_newest = "date_added"
+    # Within a book, the toc is requested first and assets last.
+    stage_priorities = {'toc': 3, 'page_json': 2, 'content': 1, 'asset': 0}
 
     def __init__(
             self,
@@ -68,33 +54,210 @@ class SafariBooksSpider(scrapy.spiders.Spider):
             cookie,
             book_id,
             output_directory=None,
-            query=None
+            queries=None,
+            loop=False,
+            refresh=False,
+            shard_by=None
     ):
         self.user = user
-        self.query = query
+        self.queries = queries or []
         self.password = password
         self.cookie = cookie
         self.book_id = book_id
-        self.book_name = ''
+        self.loop = loop
+        self.refresh = refresh
+        self.shard_by = shard_by
         self.output_directory = utils.mkdirp(
             output_directory or tempfile.mkdtemp()
         )
-        self.epub_path = ''
-        self.style = ''
-        self.info = {}
-        self._stage_toc = False
-        self.tmpdir = None
-        self._scraped_books = 0
-        self._initialize_tempdir()
-
-    def _initialize_tempdir(self):
-        self.tmpdir = tempfile.mkdtemp()
-        self.logger.info(
-            'Using `{0}` as temporary directory'.format(self.tmpdir)
+        self.books = {}
+        self.books_in_flight = 1
+        self.book_max_pending = 100
+        self._books_started = 0
+        self.asset_cache = None
+        self.render_pool = None
+        self.catalog = None
+        self._moved_searches = set()
+        self._heartbeat = None
+        self._listener = None
+        self._last_claim = 0
+        self._logged_in = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(SafariBooksSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        spider.asset_cache = AssetCache.from_settings(crawler.settings)
+        spider.render_pool = RenderPool.from_settings(crawler.settings)
+        spider.catalog = CatalogWriter.from_settings(crawler.settings, after_flush=spider.save_cursors)
+        spider.books_in_flight = crawler.settings.getint('BOOKS_IN_FLIGHT')
+        spider.book_max_pending = crawler.settings.getint('BOOK_MAX_PENDING_REQUESTS')
+        return spider
+
+    def start_book(self, book_id):
+        """Create the state of `book_id` and return the requests to start with
+
+        A book interrupted part way is resumed from its manifest, so only the
+        missing pieces are requested.
+        """
+        self.logger.info('Start scraping, book_id: {}'.format(book_id))
+        book = Book(book_id, self.output_directory, self.settings.getint('BOOK_CHECKPOINT_ENTRIES'))
+        book.sequence = self._books_started
+        self._books_started += 1
+        self.books[book_id] = book
+        if book.toc is None:
+            return [self.book_request(
+                book,
+                'toc',
+                self.toc_url + book_id,
+                partial(self.parse_toc, book),
+                partial(self.toc_failed, book),
+                meta={'http_cache': True},
+            )]
+        requests = list(self.book_requests(book))
+        if not requests:
+            self.finish_book(book)
+        return requests
+
+    def finish_book(self, book):
+        if self.books.pop(book.book_id, None) is None:
+            return
+        book.finish()
+        self.logger.info('Finish scraping, book_id: {}'.format(book.book_id))
+
+    def claim_books(self):
+        """Claim books from DB until `books_in_flight` are crawled at once, return the requests to start with"""
+        requests = []
+        self._last_claim = time.time()
+        models = ModelBooks.claim_books(self.books_in_flight - len(self.books))
+        if not models and not self.books:
+            self.logger.info('There is no book in DB')
+        for model in models:
+            requests.extend(self.start_book(model.safari_book_id))
+        return requests
+
+    def heartbeat(self):
+        """Renew the lease on the books crawled, drop the ones it was lost on
+
+        A lost lease means the book was reclaimed and may be crawled by
+        another worker already, writing the same files.
+        """
+        if not self.books:
+            return
+        try:
+            held = ModelBooks.heartbeat(list(self.books))
+        except Exception as e:
+            # The LoopingCall stops on the first error, try again next time.
+            self.logger.error('Failed renewing the lease of {} books, {}'.format(len(self.books), e))
+            return
+        for book_id in set(self.books) - held:
+            self.books.pop(book_id).drop()
+        if self.loop and len(self.books) < self.books_in_flight:
+            for request in self.claim_books():
+                self.schedule(request)
+
+    def book_request(self, book, stage, url, callback, errback, meta=None, **kwargs):
+        """Return a request for `book`, counted in its pending requests
+
+        Requests are prioritized by book, in the order the books were started,
+        then by stage within a book. The books started first are the closest to
+        completion, so they finish one after the other, instead of all of them
+        late together with all their files open.
+        """
+        book.pending += 1
+        return scrapy.Request(
+            url,
+            callback=partial(self.book_callback, book, callback),
+            errback=partial(self.book_callback, book, errback),
+            meta=dict(meta or {}, endpoint=stage),
+            priority=self.stage_priorities[stage] - book.sequence * len(self.stage_priorities),
+            dont_filter=True,
+            **kwargs
         )
-        # `copytree` doesn't like when the target directory already exists.
-        os.rmdir(self.tmpdir)
-        shutil.copytree(utils.pkg_path('data/'), self.tmpdir)
+
+    async def book_callback(self, book, func, *args):
+        """Run the callback `func` of a request for `book`, then release the request
+
+        `func` may return a Deferred, it is awaited so the response stays
+        active in the scraper until it fires.
+        """
+        if book.dropped:
+            return self.release(book)
+        try:
+            result = func(*args)
+            if isinstance(result, defer.Deferred):
+                result = await maybe_deferred_to_future(result)
+            # The requests it yields are counted before this one is released.
+            requests = list(result or [])
+        except Exception:
+            for request in self.release(book):
+                self.schedule(request)
+            raise
+        return requests + self.release(book)
+
+    def release(self, book):
+        """Release an answered request of `book`, return the requests to go on with
+
+        The next toc items are requested as the pending requests of the book
+        drop, and it is finished once none are left.
+        """
+        book.pending -= 1
+        if self.books.get(book.book_id) is not book:
+            return []
+        requests = list(self.item_requests(book))
+        if book.pending > 0:
+            return requests
+        self.finish_book(book)
+        if self.loop:
+            return self.claim_books()
+        return []
+
+    def schedule(self, request):
+        """Hand `request` to the engine from outside of a callback"""
+        self.crawler.engine.crawl(request)
+
+    def spider_idle(self, spider):
+        # In loop mode the crawler stays alive and keeps the logged in
+        # session. Books are finished as their last request is answered, one
+        # still open here lost a request on the way.
+        if not self.loop or not self._logged_in or self.queries:
+            return
+
+        for book in list(self.books.values()):
+            self.finish_book(book)
+        if self._listener is None:
+            self.start_listener()
+        # New books are announced, see `books_queued`, only look for them
+        # once in a while in case a notification is missed.
+        if self._listener is None or time.time() - self._last_claim >= self.settings.getint('BOOK_CLAIM_INTERVAL'):
+            for request in self.claim_books():
+                self.schedule(request)
+        # Nothing to claim right now, idle fires again in a few seconds.
+        raise DontCloseSpider
+
+    def start_listener(self):
+        """Claim books as soon as they are queued for download, instead of polling the table"""
+        from twisted.internet import reactor
+
+        listener = StatusListener([BookStatus.NOT_DOWNLOADED], on_notify=self.books_queued, on_lost=self.listener_lost)
+        try:
+            reactor.addReader(listener)
+        except Exception as e:
+            # Polled meanwhile, listening is tried again when idle.
+            self.logger.error('Failed listening for queued books, {}'.format(e))
+            listener.close()
+            return
+        self._listener = listener
+
+    def listener_lost(self):
+        self.logger.warning('Stopped listening for queued books, polling until listening again')
+        self._listener = None
+
+    def books_queued(self):
+        if len(self.books) >= self.books_in_flight:
+            return
+        for request in self.claim_books():
+            self.schedule(request)
 
     def parse(self, response):
         if self.cookie is not None:
@@ -122,185 +285,375 @@ class SafariBooksSpider(scrapy.spiders.Spider):
             self.logger.error('Something went wrong')
             return
 
-        if self.query is not None:
-            page = 0
-            if os.path.exists(self.page_file):
-                with open(self.page_file) as fp:
-                    page = fp.read().strip()
-                    if page:
-                        page = int(page)
-                        self._scraped_books = page * 10
-                        page += 1
-
-            post_body = {
-                "query": self.query,
-                "extended_publisher_data": "true",
-                "highlight": "true",
-                "is_academic_institution_account": "false",
-                "source": "user",
-                "include_assessments": "false",
-                "include_case_studies": "true",
-                "include_courses": "true",
-                "include_orioles": "true",
-                "include_playlists": "true",
-                "formats": ["book"],
-                "topics": [],
-                "publishers": [],
-                "languages": [],
-                "sort": self.sort_by_relevance,
-                "page": page
-            }
-            yield scrapy.Request(
-                self.search_url,
-                method='POST',
-                body=json.dumps(post_body),
-                callback=partial(self.query_books, post_body),
-                headers={"content-type": "application/json"}
-            )
+        self._logged_in = True
+
+        if self.queries:
+            # All queries are harvested at once, each with its own window.
+            self.catalog.start()
+            for query in self.queries:
+                if self.shard_by:
+                    yield self.facets_request(query)
+                    continue
+                for request in self.search_requests(self.new_search(query)):
+                    yield request
+        elif self.loop:
+            # Claimed books are leased, renew the lease while they are crawled.
+            self._heartbeat = task.LoopingCall(self.heartbeat)
+            self._heartbeat.start(self.settings.getint('BOOK_LEASE_SECONDS') / 3.0, now=False)
+            self.start_listener()
+            for request in self.claim_books():
+                yield request
         elif self.book_id:
-            yield scrapy.Request(
-                self.toc_url + self.book_id,
-                callback=self.parse_toc,
+            for request in self.start_book(self.book_id):
+                yield request
+
+    def new_search(self, query, facets=None):
+        if self.refresh:
+            # Only the books added since the last harvest, newest first.
+            return Search(
+                query,
+                self.sort_by_newest,
+                window=self.settings.getint('SEARCH_CONCURRENT_PAGES'),
+                max_books=self.MAX_NUMBER_OF_BOOKS,
+                stop_after=self.settings.getint('SEARCH_REFRESH_KNOWN_PAGES'),
+                facets=facets,
             )
+        return Search(
+            query,
+            self.sort_by_relevance,
+            start_page=ModelSearchCursors.start_page(query, self.sort_by_relevance, shard_key(facets)),
+            window=self.settings.getint('SEARCH_CONCURRENT_PAGES'),
+            max_books=self.MAX_NUMBER_OF_BOOKS,
+            facets=facets,
+        )
 
-    @with_transaction
-    def save_books_in_db(self, books_dict):
-        existed_models = SESSION.query(ModelBooks).filter(ModelBooks.safari_book_id.in_(books_dict.keys())).all()
-        existed_book_ids = []
-        for model in existed_models:
-            tags = set(model.tags)
-            if self.query:
-                tags.add(self.query)
-            model.tags = list(tags)
-            existed_book_ids.append(model.safari_book_id)
-
-        new_book_ids = set(books_dict.keys()) - set(existed_book_ids)
-        new_models = []
-        for book_id in new_book_ids:
-            book = books_dict[book_id]
-            new_models.append(ModelBooks(
-                safari_book_id=book['archive_id'],
-                reviews=book.get('number_of_reviews', 0),
-                rating=book.get('average_rating', 0),
-                popularity=book.get('popularity', 0),
-                report_score=book.get('report_score', 0),
-                pages=book.get('virtual_pages', 0),
-                title=book.get('title', ''),
-                language=book.get('language', ''),
-                authors=book.get('authors', []),
-                publishers=book.get('publishers', []),
-                tags=[self.query] if self.query else [],
-                description=book.get('description', ''),
-                url=book.get('url', ''),
-                web_url=book.get('web_url', ''),
-            ))
-
-        SESSION.add_all(new_models)
-        SESSION.flush()
-        return new_book_ids
-
-    def query_books(self, post_body, response):
-        response = json.loads(response.body)
-        if not response['results']:
-            return
-        total_books = response['total']
-        self._scraped_books += len(response['results'])
-        books_dict = {}
-        for book in response['results']:
-            books_dict[book['archive_id']] = book
-        if self._scraped_books < min(total_books, self.MAX_NUMBER_OF_BOOKS):
-            self.save_books_in_db(books_dict)
-            with open(self.page_file, 'w') as fp:
-                fp.write('{}'.format(post_body['page']))
+    def facets_request(self, query):
+        """Request the first page of `query`, to learn the values of the facet to shard it by"""
+        return scrapy.Request(
+            self.search_url,
+            method='POST',
+            body=json.dumps(Search(query, self.sort_by_relevance).post_body(0)),
+            callback=partial(self.parse_facets, query),
+            headers={"content-type": "application/json"},
+            meta={'endpoint': 'search'},
+            dont_filter=True,
+        )
+
+    def parse_facets(self, query, response):
+        # Every shard is a small result set of its own, harvested in
+        # parallel with its own cursor, instead of paging deep into one.
+        body = json.loads(response.body)
+        counts = facet_counts(body, self.shard_by)
+        searches = [self.new_search(query, {self.shard_by: [value]}) for value, _ in counts]
+        # Books without a value of the facet, or with one cut from the list,
+        # are in no shard, the query is then harvested whole too.
+        covered = sum(count for _, count in counts)
+        whole = None
+        if not counts:
+            self.logger.warning('No {} facet for {!r}, harvesting it whole'.format(self.shard_by, query))
+            whole = self.new_search(query)
+        elif covered < body.get('total', 0):
+            self.logger.warning('The {} {} of {!r} cover {} of {} books, harvesting it whole too'.format(
+                len(counts), self.shard_by, query, covered, body['total']))
+            whole = self.new_search(query)
+        else:
+            self.logger.info('Sharding {!r} by {} {}'.format(query, len(counts), self.shard_by))
+
+        if whole is not None and whole.start_page == 0:
+            # Its first page is the one fetched already.
+            whole.next_pages()
+            for request in self.query_books(whole, 0, response):
+                yield request
+        else:
+            if whole is not None:
+                searches.append(whole)
+            # Harvested again by the searches, but not lost if one of them fails.
+            books_dict = dict((book['archive_id'], book) for book in body.get('results') or [])
+            if books_dict:
+                self.save_books_in_db(query, books_dict)
+        for search in searches:
+            for request in self.search_requests(search):
+                yield request
+
+    def book_row(self, book, query):
+        """Map a search result of `query` to the columns of `books`"""
+        return dict(
+            safari_book_id=book['archive_id'],
+            reviews=book.get('number_of_reviews', 0),
+            rating=book.get('average_rating', 0),
+            popularity=book.get('popularity', 0),
+            report_score=book.get('report_score', 0),
+            pages=book.get('virtual_pages', 0),
+            title=book.get('title', ''),
+            language=book.get('language', ''),
+            authors=book.get('authors', []),
+            publishers=book.get('publishers', []),
+            tags=[query] if query else [],
+            description=book.get('description', ''),
+            url=book.get('url', ''),
+            web_url=book.get('web_url', ''),
+        )
 
-            post_body['page'] += 1
+    def save_books_in_db(self, query, books_dict, on_flush=None):
+        """Buffer a page of search results, `on_flush` is called once they are in DB"""
+        self.catalog.add([self.book_row(book, query) for book in books_dict.values()], on_flush=on_flush)
+
+    def search_requests(self, search):
+        for page in search.next_pages():
             yield scrapy.Request(
                 self.search_url,
                 method='POST',
-                body=json.dumps(post_body),
-                callback=partial(self.query_books, post_body),
-                headers={"content-type": "application/json"}
+                body=json.dumps(search.post_body(page)),
+                callback=partial(self.query_books, search, page),
+                errback=partial(self.query_failed, search, page),
+                headers={"content-type": "application/json"},
+                meta={'endpoint': 'search'},
+                dont_filter=True,
             )
 
-    def parse_cover_img(self, name, response):
-        # inspect_response(response, self)
-        cover_img_path = os.path.join(self.tmpdir, 'OEBPS', 'cover-image.jpg')
-        with open(cover_img_path, 'wb') as fh:
-            fh.write(response.body)
-
-    def parse_content_img(self, img, response):
-        img_path = os.path.join(os.path.join(self.tmpdir, 'OEBPS'), img)
-
-        img_dir = os.path.dirname(img_path)
-        if not os.path.exists(img_dir):
-            os.makedirs(img_dir)
+    def query_books(self, search, page, response):
+        response = json.loads(response.body)
+        if search.total is None:
+            search.set_total(response['total'])
+            self.logger.info('Harvesting {}, {} books'.format(search, response['total']))
 
-        with open(img_path, 'wb') as fh:
-            fh.write(response.body)
+        books_dict = {}
+        for book in response['results']:
+            books_dict[book['archive_id']] = book
+        search.fetched(page, empty=not books_dict)
+        if search.stop_after is not None:
+            new = set(books_dict) - ModelBooks.existing_ids(books_dict)
+            if search.count_new(page, len(new)):
+                self.logger.info('Refreshed {}, nothing new after page {}'.format(search, search.last_page))
+        # An empty page is past the last results, it isn't checkpointed.
+        if books_dict:
+            self.save_books_in_db(search.query, books_dict, on_flush=partial(self.page_saved, search, page))
+
+        for request in self.search_requests(search):
+            yield request
+
+    def page_saved(self, search, page):
+        # Pages complete out of order and are written in batches, the
+        # checkpoint only covers the contiguous run of pages in DB.
+        # A refresh starts over from the newest books every time.
+        if search.saved(page) and search.stop_after is None:
+            self._moved_searches.add(search)
+
+    def save_cursors(self):
+        """Save the cursors of the searches moved by the last flush, in one transaction"""
+        if not self._moved_searches:
+            return
+        searches, self._moved_searches = self._moved_searches, set()
+        try:
+            ModelSearchCursors.save_all([
+                dict(query=search.query, sort=search.sort, shard=search.shard, last_page=search.checkpoint,
+                     total=search.total)
+                for search in searches
+            ])
+        except Exception:
+            # The rows are in DB, the cursors are saved with the next flush.
+            self.logger.error('Failed saving the cursors of {} searches'.format(len(searches)))
+            self._moved_searches |= searches
+
+    def query_failed(self, search, page, failure):
+        self.logger.error('Failed search page {}, {}, {}'.format(page, search, repr(failure.value)))
+        search.failed(page)
+        for request in self.search_requests(search):
+            yield request
+
+    def fetch_asset(self, book, url, callback, errback):
+        """Yield the request for the asset at `url` of `book`, unless it is in the asset cache
+
+        `callback` is called with the body of the asset, either right away or
+        once it is downloaded.
+        """
+        headers = {}
+        if self.asset_cache is not None:
+            body = self.asset_cache.get(url)
+            if body is not None:
+                callback(body)
+                return
+            headers = self.asset_cache.validators(url)
+
+        yield self.book_request(
+            book,
+            'asset',
+            url,
+            partial(self.parse_asset, book, url, callback, errback),
+            errback,
+            meta={'handle_httpstatus_list': [304]},
+            headers=headers,
+        )
 
-    def parse_page_json(self, title, book_id, response):
-        page_json = json.loads(response.body)
+    def parse_asset(self, book, url, callback, errback, response):
+        if response.status == 304:
+            body = self.asset_cache.revalidated(url)
+            if body is None:
+                # Evicted in the meantime, download it again.
+                yield self.book_request(
+                    book,
+                    'asset',
+                    url,
+                    partial(self.parse_asset, book, url, callback, errback),
+                    errback,
+                )
+                return
+        else:
+            body = response.body
+            if self.asset_cache is not None:
+                self.asset_cache.put(
+                    url,
+                    body,
+                    etag=utils.decode(response.headers.get('ETag')),
+                    last_modified=utils.decode(response.headers.get('Last-Modified')),
+                )
+        callback(body)
+
+    @staticmethod
+    def failed_for_good(failure):
+        """Client errors won't go away by asking again, anything else might"""
+        if not failure.check(HttpError):
+            return False
+        status = failure.value.response.status
+        return 400 <= status < 500 and status not in (408, 429)
+
+    def request_failed(self, book, path, failure):
+        """Errback of the requests for the files of `book`
+
+        A file failed for good is left out of the book, otherwise it stays
+        missing and the book is retried later.
+        """
+        self.logger.error('Failed {}, book_id: {}, {}'.format(path, book.book_id, repr(failure.value)))
+        if self.failed_for_good(failure):
+            book.fail(path)
+
+    def toc_failed(self, book, failure):
+        self.logger.error('Failed toc, book_id: {}, {}'.format(book.book_id, repr(failure.value)))
+
+    def page_json_failed(self, book, url, failure):
+        self.logger.error('Failed {}, book_id: {}, {}'.format(url, book.book_id, repr(failure.value)))
+        if self.failed_for_good(failure):
+            book.fail_item(url)
+
+    def book_requests(self, book):
+        """Yield the requests to start `book` with, the cover and the first toc items"""
+        if not book.has(COVER_PATH) and book.claim(COVER_PATH):
+            cover_path, = re.match(
+                r'<img src="(.*?)" alt.+',
+                book.toc['thumbnail_tag'],
+            ).groups()
+
+            yield self.book_request(
+                book,
+                'asset',
+                self.host + cover_path,
+                partial(self.parse_cover_img, book, 'cover-image'),
+                partial(self.request_failed, book, COVER_PATH),
+            )
 
-        style_sheets = page_json.get('stylesheets', [])
-        style_sheets_paths = []
+        for request in self.item_requests(book):
+            yield request
 
-        for style_sheet in style_sheets:
-            style_sheets_paths.append(style_sheet['full_path'])
-            yield scrapy.Request(
-                style_sheet['url'],  # I don't know when style_sheets will have multiple elements
-                callback=partial(self.load_page_style, style_sheet['full_path'])
-            )
+    def item_requests(self, book):
+        """Yield the requests for whatever is missing of the next toc items of `book`
 
-        yield scrapy.Request(
-            page_json['content'],
-            callback=partial(
-                self.parse_page,
-                title,
-                book_id,
-                page_json['full_path'],
-                page_json['images'],
-                style_sheets_paths
+        Items are taken while the book has fewer than `book_max_pending`
+        requests pending, so huge books don't flood the scheduler, and the
+        rest follow as requests are answered, see `release`.
+        """
+        if book.toc is None:
+            return
+        items = book.toc['items']
+        while book.next_item < len(items) and book.pending < self.book_max_pending:
+            item = items[book.next_item]
+            book.next_item += 1
+            page = book.pages.get(item['url'])
+            if page is not None:
+                for request in self.page_requests(book, page):
+                    yield request
+            elif item['url'] not in book.failed and book.claim(item['url']):
+                yield self.book_request(
+                    book,
+                    'page_json',
+                    self.host + item['url'],
+                    partial(self.parse_page_json, book, item['url']),
+                    partial(self.page_json_failed, book, item['url']),
+                    meta={'http_cache': True},
+                )
+
+    def page_requests(self, book, page):
+        """Yield the requests for whatever is still missing of a page"""
+        if book.claim(page['full_path']):
+            yield self.book_request(
+                book,
+                'content',
+                page['content'],
+                partial(
+                    self.parse_page,
+                    book,
+                    page['full_path'],
+                    [style_sheet['full_path'] for style_sheet in page['stylesheets']]
+                ),
+                partial(self.request_failed, book, page['full_path']),
+                meta={'http_cache': True},
             )
-        )
-
-    def load_page_style(self, full_path, response):
-        # TODO: obviously the best approach is to create file for styles
-        # and share them in the downloaded files. But you need to carefully calculates the relative path.
-        # For now just append to self.style
-        self.style += response.body
 
-    def parse_page(self, title, book_id, path, images, style, response):
-        template = Template(PAGE_TEMPLATE)
+        # Style sheets and images are known from the page json already, so
+        # they are requested along with the content instead of after it. Most
+        # of them are shared by the pages of the book, request them once.
+        for style_sheet in page['stylesheets']:
+            if not book.claim(style_sheet['full_path']):
+                continue
+            for request in self.fetch_asset(
+                book,
+                style_sheet['url'],  # I don't know when style_sheets will have multiple elements
+                partial(self.load_page_style, book, style_sheet['full_path']),
+                partial(self.request_failed, book, style_sheet['full_path']),
+            ):
+                yield request
 
-        # path might have nested directory
-        dirs_to_make = os.path.join(
-            self.tmpdir,
-            'OEBPS',
-            os.path.dirname(path),
-        )
-        if not os.path.exists(dirs_to_make):
-            os.makedirs(dirs_to_make)
-
-        oebps_body_path = os.path.join(self.tmpdir, 'OEBPS', path)
-        with codecs.open(oebps_body_path, 'wb', 'utf-8') as fh:
-            body = decode(str(BeautifulSoup(response.body, 'lxml').find('body')))
-            style = self.style if self.style != '' else DEFAULT_STYLE
-            style = decode(style)
-            fh.write(template.render(body=body, style=style))
-
-        for img in images:
-            if not img:
+        for img in page['images']:
+            if not book.claim(img):
                 continue
 
-            # fix for books which are one level down
-            img = img.replace('../', '')
+            for request in self.fetch_asset(
+                book,
+                '/'.join((self.host, 'library/view', book.toc['title_safe'], book.toc['book_id'], img)),
+                partial(self.parse_content_img, book, img),
+                partial(self.request_failed, book, img),
+            ):
+                yield request
 
-            yield scrapy.Request(
-                '/'.join((self.host, 'library/view', title, book_id, img)),
-                callback=partial(self.parse_content_img, img),
-            )
+    def parse_cover_img(self, book, name, response):
+        # inspect_response(response, self)
+        book.write(COVER_PATH, response.body)
+
+    def parse_content_img(self, book, img, body):
+        book.write(img, body)
 
-    def parse_toc(self, response):
+    def parse_page_json(self, book, url, response):
+        page_json = json.loads(response.body)
+        page = book.set_page(url, page_json)
+        for request in self.page_requests(book, page):
+            yield request
+
+    def load_page_style(self, book, full_path, body):
+        book.add_stylesheet(full_path, body)
+
+    def parse_page(self, book, path, style, response):
+        # Style sheets are shared files in the epub, link them relative to the page.
+        page_dir = posixpath.dirname(path)
+        stylesheets = [posixpath.relpath(full_path, page_dir or '.') for full_path in style]
+
+        # The page is parsed and rendered in the render pool, the response
+        # stays active in the scraper until it is done, which keeps the
+        # spider from being idle and backs off downloads while the pool is busy.
+        d = self.render_pool.render(response.body, stylesheets)
+        d.addCallback(partial(book.write, path))
+        d.addCallback(lambda _: None)
+        return d
+
+    def parse_toc(self, book, response):
         try:
             toc = json.loads(response.body)
         except Exception:
@@ -309,59 +662,22 @@ class SafariBooksSpider(scrapy.spiders.Spider):
             )
             return
 
-        self._stage_toc = True
-
-        self.book_name = toc['title_safe']
-        book_title = re.sub(r'["%*/:<>?\\|~\s]', r'_', toc['title'])  # to be used for filename
-        self.book_title = "".join([ch for ch in book_title if 32 <= ord(ch) <= 128])
-
-        cover_path, = re.match(
-            r'<img src="(.*?)" alt.+',
-            toc['thumbnail_tag'],
-        ).groups()
-
-        yield scrapy.Request(
-            self.host + cover_path,
-            callback=partial(self.parse_cover_img, 'cover-image'),
-        )
-
-        for item in toc['items']:
-            yield scrapy.Request(
-                self.host + item['url'],
-                callback=partial(
-                    self.parse_page_json,
-                    toc['title_safe'],
-                    toc['book_id'],
-                ),
-            )
-
-        content_path = os.path.join(self.tmpdir, 'OEBPS', 'content.opf')
-        with open(content_path) as fh:
-            template = Template(fh.read())
-        with codecs.open(content_path, 'wb', 'utf-8') as fh:
-            fh.write(template.render(info=toc))
-
-        toc_path = os.path.join(self.tmpdir, 'OEBPS', 'toc.ncx')
-        with open(toc_path) as fh:
-            template = Template(fh.read())
-        with codecs.open(toc_path, 'wb', 'utf-8') as fh:
-            fh.write(template.render(info=toc))
+        book.set_toc(toc)
+        for request in self.book_requests(book):
+            yield request
 
     def closed(self, reason):
-        if self._stage_toc is False:
-            self.logger.info(
-                'Did not even got toc, ignore generated file operation.'
-            )
-            ModelBooks.finish(self.book_id, BookStatus.NOT_DOWNLOADED)
-            return
-
-        zip_path = shutil.make_archive(self.book_name, 'zip', self.tmpdir)
-        self.logger.info('Made archive {0}'.format(zip_path))
-
-        self.epub_path = os.path.join(
-            self.output_directory, '{0}.epub'.format(self.book_id),
-        )
-        self.logger.info('Moving {0} to {1}'.format(zip_path, self.epub_path))
-        shutil.move(zip_path, self.epub_path)
-        shutil.rmtree(self.tmpdir, ignore_errors=True)
-        ModelBooks.finish(self.book_id)
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        if self._listener is not None:
+            from twisted.internet import reactor
+
+            listener, self._listener = self._listener, None
+            reactor.removeReader(listener)
+            listener.close()
+        self.catalog.close()
+        for book in list(self.books.values()):
+            self.finish_book(book)
+        if self.asset_cache is not None:
+            self.asset_cache.close()
+        self.render_pool.close()
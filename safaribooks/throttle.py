@@ -0,0 +1,161 @@
+"""
+Adaptive throttling per endpoint of the site
+
+Requests carrying an ``endpoint`` meta key (``search``, ``toc``,
+``page_json``, ``content``, ``asset``) are downloaded in a slot of their own,
+so a slow endpoint does not hold back the others. The concurrency of every
+slot grows while its responses are fast and healthy, and is cut sharply, along
+with a delay between requests, as soon as the site answers ``429`` or
+``503``, honoring ``Retry-After``. Answers to requests sent before the
+backoff don't relax it, and the delay is held for the whole backoff window.
+"""
+
+import logging
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointState(object):
+    def __init__(self, concurrency, delay):
+        self.concurrency = float(concurrency)
+        self.delay = delay
+        self.latency = None
+        # When the last backoff happened, and until when its delay is held.
+        self.backoff_time = None
+        self.hold_until = 0.0
+
+    def __repr__(self):
+        return '<EndpointState(concurrency={:.1f}, delay={:.2f}, latency={})>'.format(
+            self.concurrency, self.delay, self.latency)
+
+
+class AdaptiveThrottle(object):
+    """Downloader middleware adjusting the slot of every endpoint
+
+    Concurrency grows additively, by about one per round of healthy
+    responses, while the average latency stays under
+    ``ADAPTIVE_THROTTLE_TARGET_LATENCY``, and shrinks by one above it. A
+    throttling answer halves it and doubles the delay, other server errors
+    and download errors shrink it by a quarter.
+
+    The delay is held, and the concurrency doesn't grow, until
+    ``Retry-After`` or the delay itself has passed since the backoff. Then
+    every healthy response shrinks the delay by
+    ``ADAPTIVE_THROTTLE_DELAY_DECAY``. The answers to requests sent before a
+    backoff were throttled already, they neither relax it nor back off again.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.start_concurrency = settings.getint('ADAPTIVE_THROTTLE_START_CONCURRENCY')
+        self.min_concurrency = settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY')
+        self.max_concurrency = settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY')
+        self.target_latency = settings.getfloat('ADAPTIVE_THROTTLE_TARGET_LATENCY')
+        self.backoff_delay = settings.getfloat('ADAPTIVE_THROTTLE_BACKOFF_DELAY')
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY')
+        self.delay_decay = settings.getfloat('ADAPTIVE_THROTTLE_DELAY_DECAY')
+        self.backoff_codes = set(int(code) for code in settings.getlist('ADAPTIVE_THROTTLE_BACKOFF_HTTP_CODES'))
+        self.debug = settings.getbool('ADAPTIVE_THROTTLE_DEBUG')
+        self.endpoints = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.request_reached_downloader, signal=signals.request_reached_downloader)
+        return middleware
+
+    def _state(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = EndpointState(self.start_concurrency, 0.0)
+        return self.endpoints[endpoint]
+
+    def _apply(self, endpoint, state):
+        slot = self.crawler.engine.downloader.slots.get(endpoint)
+        if slot is None:
+            return
+        slot.concurrency = max(1, int(state.concurrency))
+        slot.delay = state.delay
+
+    def process_request(self, request, spider):
+        endpoint = request.meta.get('endpoint')
+        if endpoint is None:
+            return
+        request.meta.setdefault('download_slot', endpoint)
+
+    def request_reached_downloader(self, request, spider):
+        # Sent once the downloader has got the slot of the request, creating
+        # it with the default concurrency and no delay on the first request
+        # or after the idle ones are garbage collected, and before the slot
+        # is processed. The state outlives the slots and is applied to every
+        # new one before it sends anything.
+        endpoint = request.meta.get('endpoint')
+        if endpoint is None:
+            return
+        request.meta['throttle_sent'] = time.monotonic()
+        self._apply(endpoint, self._state(endpoint))
+
+    def process_response(self, request, response, spider):
+        endpoint = request.meta.get('endpoint')
+        latency = request.meta.get('download_latency')
+        # Responses served from the HTTP cache have no latency.
+        if endpoint is None or latency is None:
+            return response
+
+        state = self._state(endpoint)
+        now = time.monotonic()
+        sent = request.meta.get('throttle_sent', now)
+        # Sent before the last backoff, the answer says nothing about it.
+        stale = state.backoff_time is not None and sent < state.backoff_time
+        if response.status in self.backoff_codes:
+            retry_after = self._retry_after(response)
+            if not stale:
+                state.concurrency = max(self.min_concurrency, state.concurrency / 2)
+                state.delay = min(self.max_delay, max(state.delay * 2, self.backoff_delay, retry_after))
+                state.backoff_time = now
+                logger.info('Throttled on {}, status {}, backing off to {}'.format(endpoint, response.status, state))
+            state.hold_until = max(state.hold_until, now + max(state.delay, min(self.max_delay, retry_after)))
+        elif response.status >= 500:
+            self._slow_down(state)
+        elif not stale:
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency = 0.8 * state.latency + 0.2 * latency
+            if state.latency > self.target_latency:
+                state.concurrency = max(self.min_concurrency, state.concurrency - 1)
+            elif now >= state.hold_until:
+                state.concurrency = min(self.max_concurrency, state.concurrency + 1 / state.concurrency)
+            if now >= state.hold_until:
+                state.delay = state.delay * self.delay_decay if state.delay > 0.01 else 0.0
+
+        self._apply(endpoint, state)
+        if self.debug:
+            logger.debug('{} {} in {:.2f}s, {}'.format(endpoint, response.status, latency, state))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        endpoint = request.meta.get('endpoint')
+        if endpoint is None:
+            return
+        state = self._state(endpoint)
+        self._slow_down(state)
+        self._apply(endpoint, state)
+
+    def _slow_down(self, state):
+        state.concurrency = max(self.min_concurrency, state.concurrency * 0.75)
+
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get('Retry-After')
+        try:
+            return float(value) if value is not None else 0.0
+        except ValueError:
+            # An HTTP date, not worth parsing, the backoff delay applies.
+            return 0.0
@@ -32,3 +32,95 @@ def mkdirp(path):
             raise
 
     return path
+
+
+def decode(s):
+    try:
+        return s.decode("utf8")
+    except:
+        return s
+
+
+def track_lru_size(db, table):
+    """Keep the total ``size`` of the rows of a sqlite table in ``lru_sizes``
+
+    Triggers update the total in the transaction inserting, replacing or
+    deleting a row, so `evict_lru` doesn't sum the whole table, and every
+    process sharing the database agrees on it. Rows stored before the
+    triggers existed are summed once.
+
+    Args:
+        db (sqlite3.Connection):
+            Database holding `table`
+        table (str):
+            Name of the table, with a ``size`` column
+    """
+    # The row deleted by INSERT OR REPLACE only fires the delete trigger with
+    # recursive triggers on.
+    db.execute('PRAGMA recursive_triggers = ON')
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS lru_sizes (name TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+        db.execute(
+            'INSERT OR IGNORE INTO lru_sizes (name, size) SELECT ?, COALESCE(SUM(size), 0) FROM {}'.format(table),
+            (table,)
+        )
+        for event, delta in (
+            ('INSERT', 'NEW.size'),
+            ('DELETE', '-OLD.size'),
+            ('UPDATE OF size', 'NEW.size - OLD.size'),
+        ):
+            db.execute(
+                "CREATE TRIGGER IF NOT EXISTS {table}_size_{name} AFTER {event} ON {table} BEGIN "
+                "UPDATE lru_sizes SET size = size + {delta} WHERE name = '{table}'; END".format(
+                    table=table, name=event.split()[0].lower(), event=event, delta=delta)
+            )
+
+
+def evict_lru(db, table, key, max_size, cascade=()):
+    """Delete the least recently used rows of a sqlite table until it fits in `max_size`
+
+    The rows of `table` hold a ``size`` and an ``accessed_time`` column, the
+    oldest accessed ones are deleted first until their sizes sum to
+    `max_size` at most. The total is the one kept by `track_lru_size`, and the
+    rows are read through the index on ``accessed_time`` only as far as
+    needed.
+
+    Args:
+        db (sqlite3.Connection):
+            Database holding `table`
+        table (str):
+            Name of the table
+        key (str):
+            Name of the column identifying a row
+        max_size (int):
+            Size the rows must fit in
+        cascade (list):
+            Statements deleting the rows which refer to an evicted one, run
+            with its key in the same transaction
+
+    Returns:
+        list: The keys of the deleted rows
+    """
+    total, = db.execute('SELECT size FROM lru_sizes WHERE name = ?', (table,)).fetchone()
+    if total <= max_size:
+        return []
+
+    evicted = []
+    cursor = db.execute('SELECT {}, size FROM {} ORDER BY accessed_time'.format(key, table))
+    try:
+        while total > max_size:
+            rows = cursor.fetchmany(100)
+            if not rows:
+                break
+            for value, size in rows:
+                if total <= max_size:
+                    break
+                evicted.append(value)
+                total -= size
+    finally:
+        cursor.close()
+
+    with db:
+        for statement in list(cascade) + ['DELETE FROM {} WHERE {} = ?'.format(table, key)]:
+            db.executemany(statement, [(value,) for value in evicted])
+    return evicted
@@ -10,6 +10,7 @@ setup(
     description='Downloads and converts Safari Book Online books',
     long_description=__doc__,
     packages=find_packages(),
+    python_requires='>=3.6',
     package_data={
         'safaribooks': [
             'data/mimetype',
@@ -19,10 +20,14 @@ setup(
         ],
     },
     install_requires=[
-        'scrapy>=1.4.0',
-        'twisted==16.4.1',
+        'scrapy>=2.6.0',
+        'twisted>=17.9.0',
         'jinja2',
         'beautifulsoup4',
+        'lxml',
+        # `Engine.dispose(close=False)` for forked workers, 2.0 drops autocommit sessions.
+        'sqlalchemy>=1.4.33,<2',
+        'psycopg2',
     ],
     entry_points={
         'console_scripts': {
@@ -39,7 +44,6 @@ setup(
         'Programming Language :: Python',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: Implementation :: CPython',
     ],
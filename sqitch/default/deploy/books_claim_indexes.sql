@@ -0,0 +1,10 @@
+-- Deploy default:books_claim_indexes to pg
+-- requires: init_tables
+
+BEGIN;
+
+-- Books are claimed oldest first from these statuses, see `ModelBooks.claim_books`.
+CREATE INDEX books_not_downloaded_updated_time ON books (updated_time) WHERE status = 0;
+CREATE INDEX books_downloaded_updated_time ON books (updated_time) WHERE status = 2;
+
+COMMIT;
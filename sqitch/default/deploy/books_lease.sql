@@ -0,0 +1,16 @@
+-- Deploy default:books_lease to pg
+-- requires: init_tables
+
+BEGIN;
+
+-- Worker holding a book in DOWNLOADING / UPLOADING, and until when, it is
+-- returned to the queue once the lease expires without a heartbeat.
+ALTER TABLE books ADD COLUMN lease_owner VARCHAR(255);
+ALTER TABLE books ADD COLUMN lease_expires TIMESTAMP WITHOUT TIME ZONE;
+CREATE INDEX books_leased_lease_expires ON books (lease_expires) WHERE status IN (1, 3);
+
+-- Books claimed before leases existed get one, so they are reclaimed if stuck.
+UPDATE books SET lease_expires = COALESCE(updated_time, CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + INTERVAL '1 hour'
+WHERE status IN (1, 3);
+
+COMMIT;
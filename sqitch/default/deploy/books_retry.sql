@@ -0,0 +1,11 @@
+-- Deploy default:books_retry to pg
+-- requires: books_lease
+
+BEGIN;
+
+-- Failed attempts at the book, and the time before which it isn't claimed
+-- again, see `ModelBooks.finish`. Reset once the book moves on.
+ALTER TABLE books ADD COLUMN attempts SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE books ADD COLUMN retry_after TIMESTAMP WITHOUT TIME ZONE;
+
+COMMIT;
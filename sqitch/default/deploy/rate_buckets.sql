@@ -0,0 +1,13 @@
+-- Deploy default:rate_buckets to pg
+-- requires: init_tables
+
+BEGIN;
+
+-- Token buckets shared by the downloaders of all hosts, see `safaribooks.ratelimit`
+CREATE TABLE rate_buckets (
+  name                  VARCHAR(255) NOT NULL PRIMARY KEY,
+  tokens                DOUBLE PRECISION NOT NULL,
+  updated_time          TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+COMMIT;
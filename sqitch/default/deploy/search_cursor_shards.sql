@@ -0,0 +1,11 @@
+-- Deploy default:search_cursor_shards to pg
+-- requires: search_cursors
+
+BEGIN;
+
+-- Facet filter a cursor is for, e.g. `publishers=O'Reilly Media, Inc.`, empty for none.
+ALTER TABLE search_cursors ADD COLUMN shard TEXT NOT NULL DEFAULT '';
+ALTER TABLE search_cursors DROP CONSTRAINT search_cursors_pkey;
+ALTER TABLE search_cursors ADD PRIMARY KEY (query, sort, shard);
+
+COMMIT;
@@ -0,0 +1,16 @@
+-- Deploy default:search_cursors to pg
+-- requires: init_tables
+
+BEGIN;
+
+CREATE TABLE search_cursors (
+  query                 TEXT         NOT NULL,
+  sort                  VARCHAR(64)  NOT NULL,
+  last_page             INT,         -- last page of the contiguous run of pages saved in books, NULL if none yet
+  total                 INT,
+  updated_time          TIMESTAMP WITHOUT TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+  created_time          TIMESTAMP WITHOUT TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+  PRIMARY KEY (query, sort)
+);
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- Revert default:books_claim_indexes from pg
+
+BEGIN;
+
+DROP INDEX books_not_downloaded_updated_time;
+DROP INDEX books_downloaded_updated_time;
+
+COMMIT;
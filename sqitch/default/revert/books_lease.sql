@@ -0,0 +1,9 @@
+-- Revert default:books_lease from pg
+
+BEGIN;
+
+DROP INDEX books_leased_lease_expires;
+ALTER TABLE books DROP COLUMN lease_expires;
+ALTER TABLE books DROP COLUMN lease_owner;
+
+COMMIT;
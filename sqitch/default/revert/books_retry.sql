@@ -0,0 +1,8 @@
+-- Revert default:books_retry from pg
+
+BEGIN;
+
+ALTER TABLE books DROP COLUMN retry_after;
+ALTER TABLE books DROP COLUMN attempts;
+
+COMMIT;
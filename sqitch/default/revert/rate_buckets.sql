@@ -0,0 +1,7 @@
+-- Revert default:rate_buckets from pg
+
+BEGIN;
+
+DROP TABLE rate_buckets;
+
+COMMIT;
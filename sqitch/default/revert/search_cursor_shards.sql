@@ -0,0 +1,10 @@
+-- Revert default:search_cursor_shards from pg
+
+BEGIN;
+
+DELETE FROM search_cursors WHERE shard <> '';
+ALTER TABLE search_cursors DROP CONSTRAINT search_cursors_pkey;
+ALTER TABLE search_cursors DROP COLUMN shard;
+ALTER TABLE search_cursors ADD PRIMARY KEY (query, sort);
+
+COMMIT;
@@ -0,0 +1,7 @@
+-- Revert default:search_cursors from pg
+
+BEGIN;
+
+DROP TABLE search_cursors;
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- Verify default:books_claim_indexes on pg
+
+BEGIN;
+
+SELECT 1/COUNT(1) FROM pg_indexes WHERE tablename = 'books' AND indexname = 'books_not_downloaded_updated_time';
+SELECT 1/COUNT(1) FROM pg_indexes WHERE tablename = 'books' AND indexname = 'books_downloaded_updated_time';
+
+ROLLBACK;
@@ -0,0 +1,7 @@
+-- Verify default:books_lease on pg
+
+BEGIN;
+
+SELECT lease_owner, lease_expires FROM books WHERE FALSE;
+
+ROLLBACK;
@@ -0,0 +1,7 @@
+-- Verify default:books_retry on pg
+
+BEGIN;
+
+SELECT attempts, retry_after FROM books WHERE FALSE;
+
+ROLLBACK;
@@ -0,0 +1,7 @@
+-- Verify default:rate_buckets on pg
+
+BEGIN;
+
+SELECT name, tokens, updated_time FROM rate_buckets WHERE FALSE;
+
+ROLLBACK;
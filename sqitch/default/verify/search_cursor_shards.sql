@@ -0,0 +1,7 @@
+-- Verify default:search_cursor_shards on pg
+
+BEGIN;
+
+SELECT shard FROM search_cursors WHERE FALSE;
+
+ROLLBACK;
@@ -0,0 +1,7 @@
+-- Verify default:search_cursors on pg
+
+BEGIN;
+
+SELECT query, sort, last_page, total, updated_time, created_time FROM search_cursors WHERE FALSE;
+
+ROLLBACK;